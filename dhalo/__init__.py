@@ -1,28 +1,760 @@
 #!/usr/bin/env python3
+import collections
+import contextlib
+import glob
+import hashlib
+import json
 import logging
+import os
+import re
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 
 import h5py
+import numpy as np
 import pandas as pd
 
-logging.basicConfig(level=logging.DEBUG)
+dtypes = {
+    "nodeIndex": np.int64,
+    "descendantIndex": np.int64,
+    "snapshotNumber": np.int32,
+    "particleNumber": np.int32,
+    "hostIndex": np.int64,
+    "descendantHost": np.int64,
+    "isMainProgenitor": np.int32,
+}
+
+
+class Profile(object):
+    """Opt-in counters and timers of pipeline stages.
+
+    Disabled by default, when :meth:`timer` returns a shared no-op context
+    and :meth:`count` returns at once, so that instrumented code only pays
+    for an attribute check.  Stages are instrumented as a whole, never per
+    row, so that an enabled profile costs little more.  Summaries of worker
+    processes are combined with :meth:`pop` and :meth:`merge`, adding up
+    their timers.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.start = None
+        self.pid = None
+        self.seconds = collections.Counter()
+        self.calls = collections.Counter()
+        self.counters = collections.Counter()
+
+    def enable(self):
+        """Starts collecting counters and timers.
+
+        Counters and timers inherited from a forked parent process are
+        discarded, so that they are not merged back twice.
+        """
+        if self.pid != os.getpid():
+            self.pop()
+            self.pid = os.getpid()
+            self.start = time.perf_counter()
+        self.enabled = True
+
+    @contextlib.contextmanager
+    def _timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - start
+            self.calls[name] += 1
+
+    def timer(self, name):
+        """Times a block of code, as in ``with profile.timer(name):``.
+
+        :param str name: stage name
+        """
+        return self._timer(name) if self.enabled else _untimed
+
+    def count(self, name, n=1):
+        """Adds to a counter.
+
+        :param str name: counter name
+        :param int n: increment
+        """
+        if self.enabled:
+            self.counters[name] += int(n)
+
+    def summary(self):
+        """Summarises counters and timers.
+
+        :return dict: ``seconds`` since :meth:`enable`, ``timers`` with the
+            total ``seconds`` and number of ``calls`` of every stage, and
+            ``counters``
+        """
+        return {
+            "seconds": (
+                time.perf_counter() - self.start if self.start else 0.0
+            ),
+            "timers": {
+                name: {
+                    "seconds": self.seconds[name],
+                    "calls": self.calls[name],
+                }
+                for name in sorted(self.seconds)
+            },
+            "counters": dict(sorted(self.counters.items())),
+        }
+
+    def pop(self):
+        """Summarises and resets counters and timers, see :meth:`summary`.
+        """
+        summary = self.summary()
+        self.seconds.clear()
+        self.calls.clear()
+        self.counters.clear()
+        return summary
+
+    def merge(self, summary):
+        """Adds counters and timers of another :meth:`summary`.
+
+        :param dict summary: summary, e.g. of a worker process
+        """
+        for name, timer in summary["timers"].items():
+            self.seconds[name] += timer["seconds"]
+            self.calls[name] += timer["calls"]
+        self.counters.update(summary["counters"])
+
+    def dump(self, filename):
+        """Writes :meth:`summary` as JSON.
+
+        :param str filename: output file name, ``-`` for standard error
+        """
+        if filename == "-":
+            json.dump(self.summary(), sys.stderr, indent=2)
+            sys.stderr.write("\n")
+            return
+        with open(filename, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+            f.write("\n")
+
+
+class _Untimed(object):
+    """No-op context manager returned by a disabled :meth:`Profile.timer`;
+    ``contextlib.nullcontext`` needs Python 3.7.
+    """
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+
+_untimed = _Untimed()
+
+#: Counters and timers of this process, see :class:`Profile`
+profile = Profile()
+
+
+def _read_column(dataset, dtype, chunk_size, mask=None):
+    """Reads an HDF5 dataset chunk by chunk into a preallocated array.
+
+    :param h5py.Dataset dataset: one-dimensional dataset
+    :param numpy.dtype dtype: type of the output array
+    :param int chunk_size: number of rows read at once
+    :param numpy.ndarray mask: if given, only rows where it is ``True`` are
+        kept, chunk by chunk
+    :return numpy.ndarray: column
+    """
+    n = dataset.shape[0]
+    if mask is None:
+        out = np.empty(n, dtype=dtype)
+    else:
+        out = np.empty(np.count_nonzero(mask), dtype=dtype)
+        buffer = np.empty(min(chunk_size, n), dtype=dtype)
+
+    position = 0
+    for start in range(0, n, chunk_size):
+        stop = min(start + chunk_size, n)
+        if mask is None:
+            dataset.read_direct(out, np.s_[start:stop], np.s_[start:stop])
+        else:
+            dataset.read_direct(
+                buffer, np.s_[start:stop], np.s_[: stop - start]
+            )
+            chunk = buffer[: stop - start][mask[start:stop]]
+            out[position : position + len(chunk)] = chunk
+            position += len(chunk)
+    return out
+
+
+def read_hdf5(filename, columns, snapshots=None, chunk_size=2 ** 22):
+    """Reads selected columns of a DHalo HDF5 catalogue.
+
+    Every column is streamed with ``read_direct`` into a preallocated array of
+    its declared type, so that peak memory stays close to the size of the
+    output.  With a snapshot range, ``snapshotNumber`` is read first to build
+    a row mask, which is then applied to other columns chunk by chunk.
+
+    :param str filename: HDF5 file name
+    :param Dict[str, numpy.dtype] columns: names and types of columns read
+    :param Tuple[int, int] snapshots: inclusive range of ``snapshotNumber``
+        of rows kept (default: all rows)
+    :param int chunk_size: number of rows read at once
+    :return Dict[str, numpy.ndarray]: columns
+    """
+    data = {}
+    with h5py.File(filename, "r") as data_file:
+        group = data_file["/haloTrees"]
+
+        mask = None
+        if snapshots is not None:
+            snapshot = _read_column(
+                group["snapshotNumber"], dtypes["snapshotNumber"], chunk_size
+            )
+            mask = (snapshot >= snapshots[0]) & (snapshot <= snapshots[1])
+            del snapshot
+
+        for column, dtype in columns.items():
+            data[column] = _read_column(group[column], dtype, chunk_size, mask)
+            logging.debug("Read column %s from %s", column, filename)
+
+    return data
+
+
+def count_rows(filename, snapshots=None, chunk_size=2 ** 22):
+    """Counts rows of a DHalo HDF5 file, see :func:`read_hdf5`.
+
+    :param str filename: HDF5 file name
+    :param Tuple[int, int] snapshots: inclusive range of ``snapshotNumber``
+        of rows counted (default: all rows)
+    :param int chunk_size: number of rows read at once
+    :return int: number of rows in the given snapshot range
+    """
+    with h5py.File(filename, "r") as data_file:
+        snapshot = data_file["/haloTrees/snapshotNumber"]
+        if snapshots is None:
+            return snapshot.shape[0]
+        snapshot = _read_column(snapshot, dtypes["snapshotNumber"], chunk_size)
+        return np.count_nonzero(
+            (snapshot >= snapshots[0]) & (snapshot <= snapshots[1])
+        )
+
+
+def hdf5_files(filename):
+    """Lists HDF5 files of a catalogue split into ``tree_NNN.*.hdf5`` files.
+
+    :param str filename: HDF5 file name, glob pattern or directory
+    :return List[str]: file names, sorted by file number
+    """
+    if os.path.isdir(filename):
+        filename = os.path.join(filename, "*.hdf5")
+    filenames = [f for f in glob.glob(filename) if f.endswith(".hdf5")]
+    if len(filenames) == 0:
+        raise IOError("No HDF5 files match %s" % filename)
+    return sorted(
+        filenames,
+        key=lambda f: [
+            int(token) if token.isdigit() else token
+            for token in re.split(r"(\d+)", f)
+        ],
+    )
+
+
+def read_catalogue(
+    filenames, columns, snapshots=None, chunk_size=2 ** 22, processes=None
+):
+    """Reads selected columns of a catalogue split across HDF5 files.
+
+    Files are read concurrently by a pool of processes, see
+    :func:`read_hdf5`, and each is copied into preallocated output arrays as
+    soon as it arrives;  no more files than processes are read at once, so
+    that peak memory stays close to the output arrays.
+
+    :param List[str] filenames: HDF5 file names, see :func:`hdf5_files`
+    :param Dict[str, numpy.dtype] columns: names and types of columns read
+    :param Tuple[int, int] snapshots: inclusive range of ``snapshotNumber``
+        of rows kept (default: all rows)
+    :param int chunk_size: number of rows read at once
+    :param int processes: number of reading processes (default: one per
+        file, up to the number of CPUs)
+    :return Tuple[Dict[str, numpy.ndarray], List[Tuple[str, int, int]]]:
+        columns, and every file name with its ``[start, stop)`` range of rows
+    """
+    n = len(filenames)
+    if processes is None:
+        processes = min(n, os.cpu_count() or 1)
+
+    if processes > 1:
+        pool = ProcessPoolExecutor(processes)
+        map_ = pool.map
+    else:
+        pool, map_ = None, map
+    try:
+        counts = list(
+            map_(count_rows, filenames, [snapshots] * n, [chunk_size] * n)
+        )
+        stops = np.cumsum(counts)
+        files = [
+            (filename, int(stop - count), int(stop))
+            for filename, count, stop in zip(filenames, counts, stops)
+        ]
+        data = {
+            column: np.empty(stops[-1], dtype=dtype)
+            for column, dtype in columns.items()
+        }
+
+        def copy(part, filename, start, stop):
+            for column, values in part.items():
+                data[column][start:stop] = values
+            logging.debug("Read %d rows from %s", stop - start, filename)
+
+        if pool is None:
+            for filename, start, stop in files:
+                part = read_hdf5(filename, columns, snapshots, chunk_size)
+                copy(part, filename, start, stop)
+        else:
+            # keep at most one file per process in flight, so that parts
+            # waiting to be copied never add up to the whole catalogue
+            pending = {}
+            for file in files:
+                if len(pending) == processes:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        copy(future.result(), *pending.pop(future))
+                future = pool.submit(
+                    read_hdf5, file[0], columns, snapshots, chunk_size
+                )
+                pending[future] = file
+            for future in list(pending):
+                copy(future.result(), *pending.pop(future))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    return data, files
+
+
+def _ranges(lo, hi):
+    """Concatenates many ``range(lo[i], hi[i])`` without a Python loop.
+
+    :param numpy.ndarray lo: range starts
+    :param numpy.ndarray hi: range stops
+    :return Tuple[numpy.ndarray, numpy.ndarray]: concatenated ranges and, for
+        each of their elements, the position of the range it came from
+    """
+    counts = hi - lo
+    owner = np.repeat(np.arange(len(lo)), counts)
+    starts = np.cumsum(counts) - counts
+    return np.arange(counts.sum()) - (starts - lo)[owner], owner
+
+
+def _preorder(n, owners):
+    """Finds depth-first positions of nodes of trees stored generation by
+    generation.
+
+    Subtree sizes are summed from the last generation up, and every node is
+    then placed after its parent and the subtrees of its earlier siblings,
+    one generation at a time.
+
+    :param int n: number of roots (the first generation)
+    :param List[numpy.ndarray] owners: for every later generation, the
+        position in the previous one of the parent of every node, in
+        non-decreasing order
+    :return List[numpy.ndarray]: for every generation, the position of
+        every node in a pre-order, depth-first walk of its tree (roots at
+        ``0``), visiting children in generation order
+    """
+    counts = [n] + [len(owner) for owner in owners]
+    sizes = [np.ones(counts[-1], dtype=np.int64)]
+    for owner, count in zip(owners[::-1], counts[-2::-1]):
+        sizes.insert(
+            0,
+            1
+            + np.bincount(owner, weights=sizes[0], minlength=count).astype(
+                np.int64
+            ),
+        )
+    positions = [np.zeros(n, dtype=np.int64)]
+    for owner, size in zip(owners, sizes[1:]):
+        before = np.cumsum(size) - size
+        positions.append(
+            positions[-1][owner]
+            + 1
+            + before
+            - before[np.searchsorted(owner, owner)]
+        )
+    return positions
+
+
+def _checksum(filename, block_size=2 ** 26):
+    """Computes SHA-1 checksum of a file, reading it block by block.
+
+    :param str filename: file name
+    :param int block_size: number of bytes read at once
+    :return str: hexadecimal digest
+    """
+    sha = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+#: Columns holding ``nodeIndex`` values, remapped by :func:`compact_catalogue`
+id_columns = [
+    "descendantIndex",
+    "hostIndex",
+    "descendantHost",
+    "mainHostIndex",
+]
+
+#: Types of other columns of a compact catalogue
+compact_dtypes = {"snapshotNumber": np.int16, "isMainProgenitor": np.bool_}
+
+
+def compact_catalogue(columns):
+    """Remaps ids of a catalogue to dense row positions.
+
+    Every ``nodeIndex`` value becomes the ``int32`` position of its row,
+    ``-1`` for none or for ids outside the catalogue, ``snapshotNumber``
+    is downcast to ``int16`` and ``isMainProgenitor`` to ``bool``.  The
+    catalogue is then indexed by position, so that looking a halo up is an
+    array index instead of a search.
+
+    :param Dict[str, numpy.ndarray] columns: DHalo catalogue columns,
+        ``nodeIndex`` included
+    :return Tuple[Dict[str, numpy.ndarray], numpy.ndarray]: compact
+        columns, and the original ``nodeIndex`` of every row
+    """
+    ids = np.asarray(columns["nodeIndex"])
+    if len(ids) > np.iinfo(np.int32).max:
+        raise ValueError("Too many haloes (%d) for int32 rows" % len(ids))
+    order = np.argsort(ids, kind="stable")
+    keys = ids[order]
+
+    compacted = {}
+    for column, values in columns.items():
+        if column == "nodeIndex":
+            values = np.arange(len(ids), dtype=np.int32)
+        elif column in id_columns:
+            k = np.minimum(np.searchsorted(keys, values), len(keys) - 1)
+            values = np.where(keys[k] == values, order[k], -1).astype(np.int32)
+        elif column in compact_dtypes:
+            values = values.astype(compact_dtypes[column])
+        compacted[column] = values
+
+    return compacted, ids
+
+
+def _describe(filename):
+    """Describes a source file of a cache, see :meth:`DHaloReader.write_cache`.
+
+    :param str filename: file name
+    :return dict: absolute file name, size, modification time and checksum
+    """
+    stat = os.stat(filename)
+    return {
+        "filename": os.path.abspath(filename),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "checksum": _checksum(filename),
+    }
+
+
+class ProgenitorCache(object):
+    """Byte-bounded LRU cache of progenitor sets, with an on-disk store.
+
+    Progenitor sets (``nodeIndex`` values, as found by
+    :meth:`DHaloReader.halo_progenitor_ids`) are keyed on the catalogue,
+    see :meth:`DHaloReader.catalogue_key`, and on the ``nodeIndex`` of their
+    root.  Sets are independent of :math:`f`, so that CMHs for any
+    :math:`f` are computed from one cached search.  The least recently used
+    sets are evicted once the cache holds more than ``max_bytes``.
+
+    With a directory, the sets of every :meth:`put_many` call (e.g. a chunk
+    of roots of :meth:`DHaloReader.collapsed_mass_histories`) are also
+    saved there as one pack, ``<catalogue>/<digest>.npz``, holding the
+    ``ids`` of the roots and the ``values`` of their sets, split by
+    ``offsets``.  The packs of a catalogue are listed and their ``ids``
+    indexed once, on its first lookup, so that sets evicted from memory,
+    or found by an earlier session or another process, are loaded instead
+    of searched for again, at the cost of one read per pack hit rather
+    than a file system call per root.  Packs written after that are only
+    seen by new caches.  Packs are written to a temporary name and then
+    renamed, so that concurrent writers never leave a partial pack.
+
+    Lookups are counted in :attr:`counters` (and in :data:`profile`, with a
+    ``progenitor_cache_`` prefix): ``hits`` in memory, ``disk_hits``,
+    ``misses`` and ``evictions``.
+
+    :param str directory: on-disk store (default: memory only)
+    :param int max_bytes: size of sets kept in memory
+    """
+
+    def __init__(self, directory=None, max_bytes=2 ** 28):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.entries = collections.OrderedDict()
+        self.packs = {}
+        self.counters = collections.Counter()
+
+    def _count(self, name, n=1):
+        self.counters[name] += n
+        profile.count("progenitor_cache_%s" % name, n)
+
+    def _index(self, catalogue):
+        """Indexes the packs of a catalogue, once.
+
+        :param str catalogue: catalogue key
+        :return Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray, List[str]]:
+            sorted root ids, the pack and position in it of every root, and
+            pack file names
+        """
+        if catalogue not in self.packs:
+            directory = os.path.join(self.directory, catalogue)
+            filenames = (
+                sorted(
+                    os.path.join(directory, name)
+                    for name in os.listdir(directory)
+                    if name.endswith(".npz")
+                )
+                if os.path.isdir(directory)
+                else []
+            )
+            ids = [np.empty(0, dtype=np.int64)]
+            for filename in filenames:
+                with np.load(filename) as pack:
+                    ids.append(pack["ids"])
+            counts = [len(i) for i in ids[1:]]
+            pack = np.repeat(np.arange(len(counts)), counts)
+            position = np.arange(len(pack)) - np.repeat(
+                np.cumsum(counts) - counts, counts
+            )
+            ids = np.concatenate(ids)
+            order = np.argsort(ids, kind="stable")
+            self.packs[catalogue] = (
+                ids[order],
+                pack[order],
+                position[order],
+                filenames,
+            )
+            logging.debug(
+                "Indexed %d progenitor sets in %d packs of %s",
+                len(ids),
+                len(filenames),
+                directory,
+            )
+        return self.packs[catalogue]
+
+    def get_many(self, catalogue, ids):
+        """Looks progenitor sets of many roots up, in memory and then on
+        disk.
+
+        :param str catalogue: catalogue key
+        :param List[int] ids: ``nodeIndex`` of every root
+        :return List[numpy.ndarray]: progenitor ids of every root, ``None``
+            if not cached
+        """
+        found = [None] * len(ids)
+        missing = []
+        for i, index in enumerate(ids):
+            key = catalogue, int(index)
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                found[i] = self.entries[key]
+            else:
+                missing.append(i)
+        self._count("hits", len(ids) - len(missing))
+
+        if missing and self.directory is not None:
+            keys, packs, positions, filenames = self._index(catalogue)
+            if len(keys) > 0:
+                missing = np.array(missing)
+                query = np.asarray(ids, dtype=np.int64)[missing]
+                k = np.minimum(np.searchsorted(keys, query), len(keys) - 1)
+                hit = keys[k] == query
+                for p in np.unique(packs[k[hit]]):
+                    with np.load(filenames[p]) as pack:
+                        offsets, values = pack["offsets"], pack["values"]
+                    here = hit & (packs[k] == p)
+                    for i, j in zip(missing[here], positions[k[here]]):
+                        found[i] = values[offsets[j] : offsets[j + 1]].copy()
+                        self._keep((catalogue, int(ids[i])), found[i])
+                self._count("disk_hits", int(np.count_nonzero(hit)))
+                missing = missing[~hit]
+        self._count("misses", len(missing))
+        return found
+
+    def put_many(self, catalogue, ids, sets):
+        """Caches progenitor sets of many roots, as one pack on disk.
+
+        :param str catalogue: catalogue key
+        :param List[int] ids: ``nodeIndex`` of every root
+        :param List[numpy.ndarray] sets: progenitor ids of every root
+        """
+        ids = np.array(ids, dtype=np.int64)
+        sets = [np.array(values, dtype=np.int64) for values in sets]
+        offsets = np.append(0, np.cumsum([len(values) for values in sets]))
+        if self.directory is not None and len(ids) > 0:
+            directory = os.path.join(self.directory, catalogue)
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(
+                directory, "%s.npz" % hashlib.sha1(ids.tobytes()).hexdigest()
+            )
+            if not os.path.exists(path):
+                temporary = "%s.%d.tmp" % (path, os.getpid())
+                with open(temporary, "wb") as f:
+                    np.savez(
+                        f,
+                        ids=ids,
+                        offsets=offsets,
+                        values=np.concatenate(sets),
+                    )
+                os.replace(temporary, path)
+        for index, values in zip(ids, sets):
+            self._keep((catalogue, int(index)), values)
+
+    def get(self, key):
+        """Looks a progenitor set up, see :meth:`get_many`.
+
+        :param Tuple[str, int] key: catalogue key and ``nodeIndex``
+        :return numpy.ndarray: progenitor ids, or ``None`` if not cached
+        """
+        return self.get_many(key[0], [key[1]])[0]
+
+    def put(self, key, values):
+        """Caches a progenitor set, see :meth:`put_many`.
+
+        :param Tuple[str, int] key: catalogue key and ``nodeIndex``
+        :param numpy.ndarray values: progenitor ids
+        """
+        self.put_many(key[0], [key[1]], [values])
+
+    def _keep(self, key, values):
+        if key in self.entries:
+            self.bytes -= sys.getsizeof(self.entries.pop(key))
+        self.entries[key] = values
+        self.bytes += sys.getsizeof(values)
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= sys.getsizeof(evicted)
+            self._count("evictions")
 
 
 class DHaloReader(object):
     """DHalo Reader class.
+
+    :param str filename: column cache directory, or HDF5 file name, glob
+        pattern (e.g. ``tree_075.*.hdf5``) or directory of a catalogue split
+        into several files, read as one
+    :param List[str] columns: columns read (default: all);  ``nodeIndex`` is
+        always read
+    :param Tuple[int, int] snapshots: inclusive range of ``snapshotNumber``
+        of haloes read (default: all);  progenitor searches only need
+        snapshots up to that of the root.  A cache partitioned by snapshot
+        only maps the rows of the range, see :meth:`write_cache`
+    :param int chunk_size: number of rows read from HDF5 at once
+    :param int processes: number of processes reading HDF5 files (default:
+        one per file, up to the number of CPUs)
+    :param bool compact: remap ids to dense row positions and downcast
+        columns, see :func:`compact_catalogue`;  all methods then take and
+        return dense ids, translated with :meth:`compact_ids` and
+        :meth:`original_ids`
+    :param ProgenitorCache progenitor_cache: memoises progenitor searches,
+        see :meth:`halo_progenitor_ids` (default: none)
+
+    The catalogue is held in :attr:`core`, a dictionary of NumPy columns
+    (``nodeIndex`` included) which all methods work on;  :attr:`data` views
+    it as a :class:`pandas.DataFrame`.
     """
 
-    def __init__(self, filename):
+    def __init__(
+        self,
+        filename,
+        columns=None,
+        snapshots=None,
+        chunk_size=2 ** 22,
+        processes=None,
+        compact=False,
+        progenitor_cache=None,
+    ):
         self.filename = filename
-        self.columns = [
-            "nodeIndex",
-            "descendantIndex",
-            "snapshotNumber",
-            "particleNumber",
-            "hostIndex",
-            "descendantHost",
-            "isMainProgenitor",
+        self.columns = ["nodeIndex"] + [
+            column
+            for column in (dtypes if columns is None else columns)
+            if column != "nodeIndex"
         ]
-        self.data = self.read()
+        self.snapshots = snapshots
+        self.chunk_size = chunk_size
+        self.processes = processes
+        self.files = []
+        self.partitions = None
+        self._source = None
+        self._catalogue = None
+        self._first = None
+        self.progenitor_cache = progenitor_cache
+        self.core = self.read()
+        self.ids = None
+        if compact:
+            self.core, self.ids = compact_catalogue(self.core)
+        self._data = None
+        self._keys = None
+        self._order = None
+        self._progenitors = None
+        self._main_progenitors = None
+        self._descendants = None
+
+    @property
+    def data(self):
+        """DHalo catalogue as a :class:`pandas.DataFrame`, indexed by
+        ``nodeIndex``.
+
+        Built from :attr:`core` on first use, sharing its memory, and rebuilt
+        after columns are added;  meant for output and interactive use, as
+        methods of the reader never go through it.
+        """
+        if self._data is None:
+            columns = dict(self.core)
+            index = columns.pop("nodeIndex")
+            self._data = pd.DataFrame(
+                columns,
+                index=(
+                    pd.Index(index, name="nodeIndex")
+                    if self.ids is None
+                    else pd.RangeIndex(len(index), name="nodeIndex")
+                ),
+                copy=False,
+            )
+        return self._data
+
+    def _add_column(self, column, values):
+        """Adds a derived column to :attr:`core`.
+
+        :param str column: column name
+        :param numpy.ndarray values: column
+        """
+        self.core[column] = values
+        self._data = None
+
+    def reset(self):
+        """Drops results cached by earlier calls, so that they are computed
+        again.
+
+        Derived columns (not in :data:`dtypes`, e.g. ``mainHostIndex`` and
+        ``hostMass``) are removed from :attr:`core`, together with the id,
+        progenitor and descendant indices;  :attr:`progenitor_cache` is kept.
+        """
+        self.core = {
+            column: values
+            for column, values in self.core.items()
+            if column in dtypes
+        }
+        self._data = None
+        self._keys = None
+        self._order = None
+        self._progenitors = None
+        self._main_progenitors = None
+        self._descendants = None
 
     def read(self):
         """Reads DHalo data into memory
@@ -60,100 +792,654 @@ class DHaloReader(object):
             merger history which works for main progenitors only
         isMainProgenitor:
             1 if it is
-        """
 
-        if self.filename.endswith(".pkl"):
-            logging.debug("Loading pickle file %s", self.filename)
-            data = pd.read_pickle(self.filename)
+        :return Dict[str, numpy.ndarray]: columns
+        """
 
-        elif self.filename.endswith(".hdf5"):
-            logging.debug("Loading HDF5 file %s", self.filename)
-            with h5py.File(self.filename, "r") as data_file:
+        if os.path.exists(os.path.join(self.filename, "manifest.json")):
+            logging.debug("Memory-mapping cache %s", self.filename)
+            with profile.timer("cache_read"):
+                data = self.read_cache()
 
-                data = pd.DataFrame(
-                    {
-                        column: data_file["/haloTrees/%s" % column].value
-                        for column in self.columns
-                    }
-                ).set_index("nodeIndex")
-
-                # with open("./data/cache.pkl", "w") as pickle_file:
-                #     data.to_pickle(pickle_file)
+        elif os.path.isdir(self.filename) or self.filename.endswith(".hdf5"):
+            logging.debug("Loading HDF5 file(s) %s", self.filename)
+            with profile.timer("hdf5_read"):
+                data, self.files = read_catalogue(
+                    hdf5_files(self.filename),
+                    {column: dtypes[column] for column in self.columns},
+                    self.snapshots,
+                    self.chunk_size,
+                    self.processes,
+                )
+            profile.count("hdf5_files", len(self.files))
 
         else:
             raise TypeError("Unknown filetype %s" % self.filename)
 
+        profile.count("rows_read", len(data["nodeIndex"]))
         return data
 
-    def get_halo(self, index):
-        """Returns halo (row of data) given a ``nodeIndex``
+    def read_cache(self):
+        """Memory-maps a column cache written by :meth:`write_cache`.
+
+        Columns are opened read-only, so that processes on one node share
+        them through the page cache instead of each holding a private copy.
+        Derived columns (not in :data:`dtypes`) are always opened, others
+        only if selected.  A snapshot range of a cache partitioned by
+        snapshot is a slice of the mapped columns, so that rows outside it
+        are never read;  in an older cache, it is applied by copying the
+        rows selected.
+
+        :raises ValueError: if the cache is stale against its source file,
+            or does not match its manifest
+        :return Dict[str, numpy.ndarray]: columns
+        """
+        with open(os.path.join(self.filename, "manifest.json")) as f:
+            manifest = json.load(f)
+
+        for source in manifest["source"]:
+            if not os.path.exists(source["filename"]):
+                logging.warning(
+                    "Source %s of cache %s not found, cannot check if it is "
+                    "up to date",
+                    source["filename"],
+                    self.filename,
+                )
+            elif (
+                os.path.getsize(source["filename"]) != source["size"]
+                or os.path.getmtime(source["filename"]) != source["mtime"]
+            ) and _checksum(source["filename"]) != source["checksum"]:
+                raise ValueError(
+                    "Cache %s is stale against %s"
+                    % (self.filename, source["filename"])
+                )
+        self._source = manifest["source"]
+        self.files = sorted(
+            (
+                (source["filename"], start, stop)
+                for source in manifest["source"]
+                for start, stop in (
+                    source["rows"]
+                    if np.ndim(source["rows"]) == 2
+                    else [source["rows"]]
+                )
+            ),
+            key=lambda f: f[1],
+        )
+
+        columns = {}
+        for column, dtype in manifest["columns"].items():
+            values = np.load(
+                os.path.join(self.filename, "%s.npy" % column), mmap_mode="r"
+            )
+            if values.dtype != dtype or values.shape != (manifest["rows"],):
+                raise ValueError(
+                    "Column %s does not match manifest of cache %s"
+                    % (column, self.filename)
+                )
+            columns[column] = values
+
+        mask = slice(None)
+        if "partitions" in manifest:
+            numbers = np.array(manifest["partitions"]["snapshotNumber"])
+            self._first = int(numbers[0]) if len(numbers) else 0
+            offsets = np.array(manifest["partitions"]["offsets"])
+            if self.snapshots is not None:
+                first = np.searchsorted(numbers, self.snapshots[0])
+                last = np.searchsorted(numbers, self.snapshots[1], "right")
+                mask = slice(offsets[first], offsets[last])
+                numbers = numbers[first:last]
+                offsets = offsets[first : last + 1] - offsets[first]
+            self.partitions = numbers, offsets
+        elif self.snapshots is not None:
+            mask = (columns["snapshotNumber"] >= self.snapshots[0]) & (
+                columns["snapshotNumber"] <= self.snapshots[1]
+            )
+            self._first = int(columns["snapshotNumber"].min(initial=0))
+        if self.snapshots is not None:
+            bounds = np.array(
+                [(start, stop) for _, start, stop in self.files], dtype=int
+            ).reshape(-1, 2)
+            if isinstance(mask, slice):
+                bounds = np.clip(bounds - mask.start, 0, offsets[-1])
+            else:
+                bounds = np.append(0, np.cumsum(mask))[bounds]
+            self.files = [
+                (filename, int(start), int(stop))
+                for (filename, _, _), (start, stop) in zip(self.files, bounds)
+                if start < stop
+            ]
+        columns = {
+            column: values[mask]
+            for column, values in columns.items()
+            if column not in dtypes or column in self.columns
+        }
+        self.columns = list(columns)
+        return columns
+
+    def write_cache(self, directory):
+        """Writes the catalogue to a memory-mappable column cache.
+
+        The cache is a directory holding one raw NumPy ``<column>.npy`` file
+        per column, ``nodeIndex`` included (with original ids and types if
+        the catalogue is compact), and a ``manifest.json``::
+
+            {
+                "rows": 1234,
+                "columns": {"nodeIndex": "<i8", "snapshotNumber": "<i4", ...},
+                "source": [
+                    {
+                        "filename": "/path/to/tree_075.0.hdf5",
+                        "size": 56789,
+                        "mtime": 1530000000.0,
+                        "checksum": "<SHA-1 of the source file>",
+                        "rows": [[0, 56], [120, 178], ...]
+                    },
+                    ...
+                ]
+            }
+
+        with one ``source`` entry per HDF5 file, and the ranges of rows read
+        from it.  The manifest of an existing cache is removed before any
+        column is overwritten, and the new one is written last (and renamed
+        into place), so an interrupted write, or rewrite, leaves no usable
+        cache behind.  Reading a cache (by passing its
+        directory to :class:`DHaloReader`) refuses it if any source file has
+        changed.
+
+        Rows are sorted by ``snapshotNumber`` (and then by source file,
+        keeping their order otherwise), and the manifest holds the offsets of
+        every snapshot::
+
+            "partitions": {
+                "snapshotNumber": [0, 1, ...],
+                "offsets": [0, 123, ..., 1234]
+            }
+
+        so that rows of ``snapshotNumber[i]`` are ``offsets[i]:offsets[i +
+        1]``, and a snapshot range is read as a slice.
+
+        :param str directory: cache directory, created if needed
+        :raises ValueError: if the catalogue is compact and was read with a
+            snapshot range, as ids pointing outside it (e.g.
+            ``descendantIndex`` of its last snapshot) were remapped to ``-1``
+            and cannot be restored
+        """
+        if self.ids is not None and self.snapshots is not None:
+            raise ValueError(
+                "Cannot cache a compact catalogue read with a snapshot range"
+            )
+        snapshot = self.core["snapshotNumber"]
+        owner = np.zeros(len(snapshot), dtype=np.int64)
+        for i, (_, start, stop) in enumerate(self.files):
+            owner[start:stop] = i
+        order = np.lexsort((owner, snapshot))
+        owner, snapshot = owner[order], snapshot[order]
+
+        # runs of rows of one snapshot and one file, in the new order
+        starts = np.flatnonzero(
+            np.append(True, (np.diff(owner) != 0) | (np.diff(snapshot) != 0))
+        )
+        stops = np.append(starts[1:], len(order))
+        descriptions = {
+            description["filename"]: description
+            for description in self._source
+            or [_describe(filename) for filename, _, _ in self.files]
+        }
+        source = {}
+        for start, stop in zip(starts, stops):
+            filename = os.path.abspath(self.files[owner[start]][0])
+            source.setdefault(
+                filename, dict(descriptions[filename], rows=[])
+            )["rows"].append([int(start), int(stop)])
+        numbers, offsets = np.unique(snapshot, return_index=True)
+
+        manifest = os.path.join(directory, "manifest.json")
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        elif os.path.exists(manifest):
+            os.remove(manifest)
+        columns = dict(self.core)
+        if self.ids is not None:
+            for column, values in columns.items():
+                if column == "nodeIndex" or column in id_columns:
+                    columns[column] = self.original_ids(values)
+                elif column in dtypes:
+                    columns[column] = values.astype(dtypes[column])
+        for column, values in columns.items():
+            np.save(os.path.join(directory, "%s.npy" % column), values[order])
+        with open(manifest + ".part", "w") as f:
+            json.dump(
+                {
+                    "rows": len(order),
+                    "columns": {
+                        column: values.dtype.str
+                        for column, values in columns.items()
+                    },
+                    "source": list(source.values()),
+                    "partitions": {
+                        "snapshotNumber": numbers.tolist(),
+                        "offsets": np.append(offsets, len(order)).tolist(),
+                    },
+                },
+                f,
+                indent=4,
+            )
+        os.replace(manifest + ".part", manifest)
+        logging.info("Wrote %d columns to cache %s", len(columns), directory)
+
+    def halo_file(self, index):
+        """Finds HDF5 file a halo was read from.
 
         :param int index: ``nodeIndex`` queried
-        :return numpy.ndarray: row of argument ``d`` of the given ``nodeIndex``
+        :return str: file name
         """
-        try:
-            halo = self.data.loc[index]
-        except KeyError:
+        row = self._row(index)
+        stops = [stop for _, _, stop in self.files]
+        return self.files[np.searchsorted(stops, row, side="right")][0]
+
+    def compact_ids(self, ids):
+        """Translates original ``nodeIndex`` values to ids of a compact
+        catalogue, see :func:`compact_catalogue`.
+
+        :param numpy.ndarray ids: original ``nodeIndex`` values
+        :return numpy.ndarray: dense ids (row positions)
+        """
+        rows, found = self._search(ids)
+        if not np.all(found):
             raise IndexError(
-                "Halo id %d not found in %s" % (index, self.filename)
+                "Halo id %d not found in %s"
+                % (np.extract(~found, ids)[0], self.filename)
             )
+        return rows.astype(np.int32)
+
+    def original_ids(self, ids):
+        """Translates ids of a compact catalogue back to original
+        ``nodeIndex`` values, see :func:`compact_catalogue`.
+
+        :param numpy.ndarray ids: dense ids (row positions), ``-1`` for none
+        :return numpy.ndarray: original ``nodeIndex`` values, ``-1`` for none
+        """
+        ids = np.asarray(ids).astype(np.int64, copy=False)
+        return np.where(ids == -1, -1, self.ids[ids])
+
+    def snapshot_rows(self, snapshot):
+        """Finds rows of haloes of a snapshot.
+
+        :param int snapshot: ``snapshotNumber`` queried
+        :return slice / numpy.ndarray: rows of columns of :attr:`core`, a
+            slice if read from a cache partitioned by snapshot (see
+            :meth:`write_cache`), a mask otherwise
+        """
+        if self.partitions is None:
+            return self.core["snapshotNumber"] == snapshot
+        numbers, offsets = self.partitions
+        i = np.searchsorted(numbers, snapshot)
+        if i == len(numbers) or numbers[i] != snapshot:
+            return slice(0, 0)
+        return slice(offsets[i], offsets[i + 1])
+
+    def _id_index(self):
+        """Returns original ``nodeIndex`` values (:attr:`ids` of a compact
+        catalogue) sorted, building it on first use.
+
+        :return Tuple[numpy.ndarray, numpy.ndarray]: sorted ids, and their
+            rows
+        """
+        if self._order is None:
+            with profile.timer("id_index"):
+                ids = self.core["nodeIndex"] if self.ids is None else self.ids
+                self._order = np.argsort(ids, kind="stable")
+                self._keys = ids[self._order]
+        return self._keys, self._order
+
+    def _search(self, ids):
+        """Finds rows of original ``nodeIndex`` values, by binary search of
+        :meth:`_id_index`.
+
+        :param numpy.ndarray ids: original ``nodeIndex`` values
+        :return Tuple[numpy.ndarray, numpy.ndarray]: rows, and whether each
+            id was found (rows of missing ids are undefined)
+        """
+        keys, order = self._id_index()
+        ids = np.asarray(ids)
+        if len(keys) == 0:
+            return (
+                np.zeros(ids.shape, dtype=np.int64),
+                np.zeros(ids.shape, dtype=bool),
+            )
+        k = np.minimum(keys.searchsorted(ids), len(keys) - 1)
+        return order[k], keys[k] == ids
+
+    def _find(self, ids):
+        """Finds rows of haloes, see :meth:`_search`.
+
+        Ids of a compact catalogue are rows already.
+
+        :param numpy.ndarray ids: ``nodeIndex`` values
+        :return Tuple[numpy.ndarray, numpy.ndarray]: rows, and whether each
+            id was found
+        """
+        if self.ids is None:
+            return self._search(ids)
+        ids = np.asarray(ids)
+        found = (ids >= 0) & (ids < len(self.ids))
+        return np.where(found, ids, 0).astype(np.int64, copy=False), found
+
+    def _rows(self, ids):
+        """Finds rows of haloes, see :meth:`_find`.
+
+        :param numpy.ndarray ids: ``nodeIndex`` values
+        :raises IndexError: if any halo is not found
+        :return numpy.ndarray: rows
+        """
+        rows, found = self._find(ids)
+        if not np.all(found):
+            raise IndexError(
+                "Halo id %d not found in %s"
+                % (np.extract(~found, ids)[0], self.filename)
+            )
+        return rows
+
+    def _row(self, index):
+        """Finds row of a single halo, without the array overhead of
+        :meth:`_rows`.
+
+        :param int index: ``nodeIndex`` queried
+        :raises IndexError: if the halo is not found
+        :return int: row
+        """
+        if self.ids is not None:
+            if 0 <= index < len(self.ids):
+                return int(index)
+        else:
+            keys, order = self._id_index()
+            k = keys.searchsorted(index)
+            if k < len(keys) and keys[k] == index:
+                return int(order[k])
+        raise IndexError("Halo id %d not found in %s" % (index, self.filename))
+
+    def get_halo(self, index):
+        """Returns halo (row of data) given a ``nodeIndex``
+
+        :param int index: ``nodeIndex`` queried
+        :return pandas.Series: columns of the given ``nodeIndex``, named by it
+        """
+        halo = self.data.iloc[self._row(index)]
+        halo.name = index
         return halo
 
+    def progenitor_index(self):
+        """Returns compressed-sparse-row progenitor index, building it on
+        first use.
+
+        Every distinct ``(descendantHost, hostIndex)`` pair of the catalogue
+        is an edge from a host to one of its progenitors.  Edges are sorted
+        once by ``descendantHost`` (ties kept in catalogue order), so that
+        progenitors of host ``keys[k]`` are ``values[offsets[k]:offsets[k +
+        1]]``.
+
+        :return Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]: sorted
+            unique ``descendantHost`` keys, row offsets and ``hostIndex``
+            values
+        """
+        if self._progenitors is None:
+            with profile.timer("progenitor_index"):
+                self._progenitors = self._progenitor_index()
+            logging.debug(
+                "Built progenitor index (%d hosts, %d edges)",
+                len(self._progenitors[0]),
+                len(self._progenitors[2]),
+            )
+        return self._progenitors
+
+    def _progenitor_index(self):
+        """Builds the progenitor index, see :meth:`progenitor_index`."""
+        descendant_host = self.core["descendantHost"]
+        host = self.core["hostIndex"]
+
+        # keep first occurrence of every (descendantHost, hostIndex) edge
+        order = np.lexsort((np.arange(len(host)), host, descendant_host))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = (
+            descendant_host[order][1:] != descendant_host[order][:-1]
+        ) | (host[order][1:] != host[order][:-1])
+        rows = np.sort(order[first])
+        rows = rows[np.argsort(descendant_host[rows], kind="stable")]
+
+        keys, offsets = np.unique(descendant_host[rows], return_index=True)
+        return keys, np.append(offsets, len(rows)), host[rows]
+
+    def direct_progenitor_ids(self, index):
+        """Finds indices of direct progenitors of a halo.
+
+        :param int index: ``nodeIndex`` queried
+        :return numpy.ndarray: unique ``hostIndex`` values of haloes of which
+            ``index`` is a host of a descendant, in catalogue order
+        """
+        keys, offsets, values = self.progenitor_index()
+        k = np.searchsorted(keys, index)
+        if k == len(keys) or keys[k] != index:
+            return values[:0]
+        return values[offsets[k] : offsets[k + 1]]
+
     def halo_progenitor_ids(self, index):
-        """Finds indices of all progenitors of a halo, recursively.
+        """Finds indices of all progenitors of a halo.
 
         The following search is employed:
 
         - find all haloes of which ``h`` is a **host of a descendant**
         - find hosts of **these haloes**
         - keep unique ones
+
+        The tree is walked depth-first with an explicit stack, so progenitors
+        are returned in the same order as by a recursive search.
         """
         _progenitors = []
-
-        def rec(i):
-            _progenitor_ids = self.data[self.data["descendantHost"] == i][
-                "hostIndex"
-            ].unique()
-            logging.debug(
-                "Progenitors recursion: %d > %d (%d progenitors)",
-                index,
-                i,
-                len(_progenitor_ids),
-            )
-            if len(_progenitor_ids) == 0:
-                return
-            for _progenitor_id in _progenitor_ids:
-                # TODO: this only eliminates fly-bys:
-                # if _progenitor_id not in _progenitors:
-                _progenitors.append(_progenitor_id)
-                rec(_progenitor_id)
-
-        rec(index)
+        # TODO: this only eliminates fly-bys:
+        # if _progenitor_id not in _progenitors:
+        with profile.timer("progenitor_search"):
+            cached = self._cached_progenitors([index])[0]
+            if cached is not None:
+                _progenitors = list(cached)
+            else:
+                stack = list(self.direct_progenitor_ids(index)[::-1])
+                while stack:
+                    i = stack.pop()
+                    _progenitors.append(i)
+                    stack.extend(self.direct_progenitor_ids(i)[::-1])
+                if self.progenitor_cache is not None:
+                    self._cache_progenitors([index], [_progenitors])
+        profile.count("progenitors", len(_progenitors))
 
         logging.info(
             "%d progenitors found for halo %d", len(_progenitors), index
         )
         return _progenitors
 
+    def catalogue_key(self):
+        """Identifies the catalogue, for :class:`ProgenitorCache`.
+
+        A digest of checksums of the source files, read from the manifest of
+        a cache or computed once, and of the first snapshot read:  progenitor
+        sets of a halo do not depend on later snapshots.  A range starting at
+        or before the first snapshot of the catalogue reads the same
+        progenitors as no range, and gets the same key.
+
+        :return str: hexadecimal digest
+        """
+        if self._catalogue is None:
+            if self._source is None:
+                self._source = [
+                    _describe(filename)
+                    for filename in dict.fromkeys(f for f, _, _ in self.files)
+                ]
+            snapshot = None
+            if (
+                self.snapshots is not None
+                and self.snapshots[0] > self._first_snapshot()
+            ):
+                snapshot = int(self.snapshots[0])
+            key = {
+                "checksums": sorted(s["checksum"] for s in self._source),
+                "snapshot": snapshot,
+            }
+            self._catalogue = hashlib.sha1(
+                json.dumps(key, sort_keys=True).encode()
+            ).hexdigest()
+        return self._catalogue
+
+    def _first_snapshot(self):
+        """Finds the first ``snapshotNumber`` of the catalogue, including
+        rows outside :attr:`snapshots`.
+
+        Read from the manifest of a cache, or from the ``snapshotNumber``
+        columns of the HDF5 files once.
+
+        :return int: snapshot number (``0`` for an empty catalogue)
+        """
+        if self._first is None:
+            first = []
+            for filename in dict.fromkeys(f for f, _, _ in self.files):
+                with h5py.File(filename, "r") as data_file:
+                    snapshot = _read_column(
+                        data_file["/haloTrees/snapshotNumber"],
+                        dtypes["snapshotNumber"],
+                        self.chunk_size,
+                    )
+                first.append(snapshot.min(initial=np.iinfo(np.int32).max))
+            self._first = int(min(first)) if first else 0
+        return self._first
+
+    def _cached_progenitors(self, ids):
+        """Looks progenitors of haloes up in :attr:`progenitor_cache`.
+
+        :param List[int] ids: ``nodeIndex`` values queried
+        :return List[numpy.ndarray]: progenitor ids of every halo, ``None``
+            if not cached
+        """
+        if self.progenitor_cache is None:
+            return [None] * len(ids)
+        found = self.progenitor_cache.get_many(
+            self.catalogue_key(),
+            ids if self.ids is None else self.original_ids(ids),
+        )
+        if self.ids is None:
+            return found
+        return [None if p is None else self.compact_ids(p) for p in found]
+
+    def _cache_progenitors(self, ids, progenitors):
+        """Stores progenitors of haloes in :attr:`progenitor_cache`.
+
+        :param List[int] ids: ``nodeIndex`` of every root
+        :param List[numpy.ndarray] progenitors: progenitor ids of every
+            root, in the order of :meth:`halo_progenitor_ids`
+        """
+        if self.ids is not None:
+            ids = self.original_ids(ids)
+            progenitors = [self.original_ids(p) for p in progenitors]
+        self.progenitor_cache.put_many(self.catalogue_key(), ids, progenitors)
+
+    def _cache_generations(self, ids, search, generations, parents, labels):
+        """Stores progenitors found by :meth:`collapsed_mass_histories`.
+
+        Progenitors of every root searched are put in the depth-first order
+        of :meth:`halo_progenitor_ids`, see :func:`_preorder`.
+
+        :param numpy.ndarray ids: ``nodeIndex`` of every root
+        :param numpy.ndarray search: whether every root was searched
+        :param List[numpy.ndarray] generations: progenitor ids of every
+            generation
+        :param List[numpy.ndarray] parents: position of the descendant of
+            every progenitor in the previous generation
+        :param List[Tuple[numpy.ndarray, numpy.ndarray]] labels: rows and
+            root of every progenitor of every generation
+        """
+        positions = _preorder(np.count_nonzero(search), parents)
+        roots = np.concatenate([roots for _, roots in labels])
+        order = np.lexsort((np.concatenate(positions[1:]), roots))
+        found = np.split(
+            np.concatenate(generations)[order],
+            np.cumsum(np.bincount(roots, minlength=len(ids)))[:-1],
+        )
+        roots = np.flatnonzero(search)
+        self._cache_progenitors(ids[roots], [found[root] for root in roots])
+
     def halo_host(self, index):
         """Finds host of halo.
 
-        Recursively continues until hits the main halo, in case of multiply
-        embedded subhaloes.
+        Follows ``hostIndex`` until hits the main halo, in case of multiply
+        embedded subhaloes.  Once :meth:`resolve_hosts` has been called, the
+        main halo is looked up instead.
         """
-        halo = self.get_halo(index)
-        return (
-            halo
-            if halo.name == halo["hostIndex"]
-            else self.halo_host(self.get_halo(halo["hostIndex"]).name)
-        )
+        row = self._row(index)
+        if "mainHostIndex" in self.core:
+            return self.get_halo(self.core["mainHostIndex"][row])
+        node, host = self.core["nodeIndex"], self.core["hostIndex"]
+        while host[row] != node[row]:
+            row = self._row(host[row])
+        return self.get_halo(node[row])
+
+    def resolve_hosts(self):
+        """Finds main halo of every halo at once.
+
+        Uses pointer jumping: every row starts pointing at the row of its
+        ``hostIndex``, and each vectorised pass replaces a pointer with the
+        pointer of its target, so that log2(depth) passes reach
+        the main haloes of arbitrarily embedded subhaloes.  The result is
+        cached as the ``mainHostIndex`` column.
+
+        :return numpy.ndarray: ``nodeIndex`` of the main halo of every row
+        """
+        if "mainHostIndex" not in self.core:
+            with profile.timer("resolve_hosts"):
+                host = self.core["hostIndex"]
+                pointer, found = self._find(host)
+                if not np.all(found):
+                    raise IndexError(
+                        "Host id %d not found in %s"
+                        % (host[~found][0], self.filename)
+                    )
+                for _ in range(int(np.log2(max(len(pointer), 1))) + 2):
+                    jumped = pointer[pointer]
+                    if np.array_equal(jumped, pointer):
+                        break
+                    pointer = jumped
+                else:
+                    raise ValueError("Cyclic hostIndex in %s" % self.filename)
+            self._add_column(
+                "mainHostIndex",
+                self.core["nodeIndex"][pointer].astype(host.dtype),
+            )
+            logging.debug("Resolved hosts of %d haloes", len(pointer))
+        return self.core["mainHostIndex"]
 
     def halo_mass(self, index):
         """Finds mass of central halo and all subhaloes.
+
+        Reads the ``hostMass`` column, computed by :meth:`host_masses`.
         """
-        return self.data[self.data["hostIndex"] == index][
-            "particleNumber"
-        ].sum()
+        return self.host_masses()[self._row(index)]
+
+    def host_masses(self):
+        """Finds mass of every halo and all its subhaloes at once.
+
+        A single ``bincount`` of ``particleNumber`` over rows of
+        ``hostIndex``, cached as the ``hostMass`` column.
+
+        :return numpy.ndarray: ``hostMass`` of every row
+        """
+        if "hostMass" not in self.core:
+            with profile.timer("host_masses"):
+                rows, valid = self._find(self.core["hostIndex"])
+                mass = np.bincount(
+                    rows[valid],
+                    weights=self.core["particleNumber"][valid],
+                    minlength=len(rows),
+                ).astype(np.int64)
+            self._add_column("hostMass", mass)
+            logging.debug("Computed masses of %d haloes", len(rows))
+        return self.core["hostMass"]
 
     def collapsed_mass_history(self, index, nfw_f):
         """Calculates mass assembly history for a given halo.
@@ -161,39 +1447,287 @@ class DHaloReader(object):
         Tree-based approach has been abandoned for performace reasons.
 
         :param int index: nodeIndex
-        :param float nfw_f: NFW :math:`f` parameter
+        :param float nfw_f: NFW :math:`f` parameter, or a list of them, all
+            computed from one progenitor search
         :return numpy.ndarray: CMH with rows formatted like ``[nodeIndex,
-            snapshotNumber, sum(particleNumber)]``
+            snapshotNumber, sum(particleNumber)]``, or a dictionary of CMHs
+            keyed by :math:`f` if a list is given
         """
 
         logging.debug("Looking for halo %d", index)
-        halo = self.get_halo(index)
-        if halo["hostIndex"] != halo.name:
+        row = self._row(index)
+        if self.core["hostIndex"][row] != index:
             raise ValueError("Not a host halo!")
-        m_0 = self.halo_mass(index)
+        m_0 = self.host_masses()[row]
 
-        progenitors = pd.concat(
-            [
-                self.data.loc[index],
-                self.data.loc[self.halo_progenitor_ids(index)],
-            ]
+        progenitors = self.halo_progenitor_ids(index)
+        rows = np.append(
+            row,
+            self._rows(
+                np.asarray(progenitors, dtype=self.core["nodeIndex"].dtype)
+            ),
         )
+        mass = self.core["particleNumber"][rows]
+        snapshot = self.core["snapshotNumber"][rows]
         logging.debug(
             "built prog sub-table [%d] (m=%d, %d progs)",
             index,
             m_0,
-            progenitors.size,
+            len(progenitors),
         )
 
-        progenitors = progenitors[progenitors["particleNumber"] > nfw_f * m_0]
-        cmh = progenitors.groupby("snapshotNumber", as_index=False)[
-            "particleNumber"
-        ].sum()
-        cmh["nodeIndex"] = index
-        logging.info(
-            "Aggregated masses of %d valid progenitors of halo %d",
-            progenitors.size,
-            index,
+        cmhs = {}
+        for f in nfw_f if np.ndim(nfw_f) else [nfw_f]:
+            with profile.timer("aggregation"):
+                valid = mass > f * m_0
+                numbers, inverse = np.unique(
+                    snapshot[valid], return_inverse=True
+                )
+                cmh = pd.DataFrame(
+                    {
+                        "snapshotNumber": numbers,
+                        "particleNumber": np.bincount(
+                            inverse,
+                            weights=mass[valid],
+                            minlength=len(numbers),
+                        ).astype(mass.dtype),
+                        "nodeIndex": np.full(len(numbers), index),
+                    },
+                    copy=False,
+                )
+            logging.info(
+                "Aggregated masses of %d valid progenitors of halo %d",
+                np.count_nonzero(valid),
+                index,
+            )
+            cmhs[f] = cmh
+        profile.count("haloes")
+
+        return cmhs if np.ndim(nfw_f) else cmhs[nfw_f]
+
+    def collapsed_mass_histories(self, ids, nfw_f):
+        """Calculates mass assembly histories for many haloes at once.
+
+        All roots are walked down the progenitor index together, one
+        generation per step, labelling every progenitor row with its root.
+        The ``nfw_f * m_0`` cut and the per-snapshot sums are then a single
+        grouped reduction over ``(root, snapshotNumber)``, repeated for
+        every :math:`f` given on the same labelled rows.  Progenitors
+        reachable through several branches are counted once per branch, as
+        in :meth:`collapsed_mass_history`.
+
+        :param List[int] ids: nodeIndex values of host haloes
+        :param float nfw_f: NFW :math:`f` parameter, or a list of them
+        :return pandas.DataFrame: CMHs in a wide format, indexed by
+            ``nodeIndex``, with one column per ``snapshotNumber``, or a
+            dictionary of them keyed by :math:`f` if a list is given
+        """
+        ids = np.unique(ids)
+        rows = self._rows(ids)
+        if np.any(self.core["hostIndex"][rows] != ids):
+            raise ValueError("Not a host halo!")
+        m_0 = self.host_masses()[rows]
+
+        keys, offsets, values = self.progenitor_index()
+        labels = [(rows, np.arange(len(ids)))]
+        with profile.timer("progenitor_search"):
+            cached = self._cached_progenitors(ids)
+            search = np.array([c is None for c in cached], dtype=bool)
+            nodes, roots = ids[search], np.flatnonzero(search)
+            generations, parents = [], []
+            while len(nodes) > 0 and len(keys) > 0:
+                k = np.minimum(np.searchsorted(keys, nodes), len(keys) - 1)
+                found = keys[k] == nodes
+                edges, owner = _ranges(
+                    np.where(found, offsets[k], 0),
+                    np.where(found, offsets[k + 1], 0),
+                )
+                nodes, roots = values[edges], roots[owner]
+                rows, found = self._find(nodes)
+                labels.append((np.where(found, rows, -1), roots))
+                generations.append(nodes)
+                parents.append(owner)
+            if self.progenitor_cache is not None and generations:
+                self._cache_generations(
+                    ids, search, generations, parents, labels[1:]
+                )
+            if not np.all(search):
+                hits = [cached[i] for i in np.flatnonzero(~search)]
+                rows, found = self._find(np.concatenate(hits))
+                labels.append(
+                    (
+                        np.where(found, rows, -1),
+                        np.repeat(
+                            np.flatnonzero(~search), [len(h) for h in hits]
+                        ),
+                    )
+                )
+            rows, roots = map(np.concatenate, zip(*labels))
+        profile.count("haloes", len(ids))
+        profile.count("progenitors", len(rows) - len(ids))
+        profile.count("generations", len(generations))
+        if np.any(rows == -1):
+            raise IndexError("Progenitor not found in %s" % self.filename)
+        logging.debug(
+            "Labelled %d progenitors of %d haloes", len(rows), len(ids)
+        )
+
+        mass = self.core["particleNumber"][rows]
+        snapshot = self.core["snapshotNumber"][rows]
+        cmhs = {}
+        for f in nfw_f if np.ndim(nfw_f) else [nfw_f]:
+            with profile.timer("aggregation"):
+                valid = mass > f * m_0[roots]
+                owners, owner = np.unique(roots[valid], return_inverse=True)
+                numbers, number = np.unique(
+                    snapshot[valid], return_inverse=True
+                )
+                table = np.bincount(
+                    owner * len(numbers) + number,
+                    weights=mass[valid],
+                    minlength=len(owners) * len(numbers),
+                )
+                cmhs[f] = pd.DataFrame(
+                    table.reshape(len(owners), len(numbers)).astype(
+                        mass.dtype
+                    ),
+                    index=pd.Index(ids[owners], name="nodeIndex"),
+                    columns=pd.Index(numbers, name="snapshotNumber"),
+                )
+            logging.info(
+                "Aggregated CMHs of %d haloes (f=%g)", len(cmhs[f]), f
+            )
+
+        return cmhs if np.ndim(nfw_f) else cmhs[nfw_f]
+
+    def _main_progenitor_rows(self):
+        """Returns the main progenitor of every halo, building it on first
+        use.
+
+        Rows flagged as ``isMainProgenitor`` are scattered to the rows of
+        their ``descendantIndex`` (the first one in catalogue order, should
+        a descendant have several).
+
+        :return numpy.ndarray: row of the main progenitor of every row,
+            ``-1`` for none
+        """
+        if self._main_progenitors is None:
+            with profile.timer("main_progenitor_index"):
+                flagged = np.flatnonzero(self.core["isMainProgenitor"])
+                rows, found = self._find(
+                    self.core["descendantIndex"][flagged]
+                )
+                main = np.full(len(self.core["nodeIndex"]), -1)
+                main[rows[found][::-1]] = flagged[found][::-1]
+            self._main_progenitors = main
+            logging.debug("Found %d main progenitors", np.sum(main != -1))
+        return self._main_progenitors
+
+    def main_branches(self, ids):
+        """Follows main progenitors of many haloes at once.
+
+        Every branch steps from its current halo back to its main
+        progenitor, all branches together in one vectorised step, until no
+        branch has one;  the number of steps is the length of the longest
+        branch, at most the number of snapshots.  Much cheaper than a CMH,
+        e.g. for formation times.
+
+        :param List[int] ids: nodeIndex values of the roots
+        :return Tuple[pandas.DataFrame, pandas.DataFrame]: ``nodeIndex`` and
+            ``particleNumber`` of the main branch of every root (rows,
+            indexed by ``nodeIndex``) at every snapshot it reaches
+            (columns), ``-1`` and ``0`` where it has no halo
+        """
+        ids = np.asarray(ids)
+        main = self._main_progenitor_rows()
+        rows, roots = self._rows(ids), np.arange(len(ids))
+        steps = [(rows, roots)]
+        with profile.timer("main_branches"):
+            while len(rows) > 0:
+                rows = main[rows]
+                found = rows != -1
+                rows, roots = rows[found], roots[found]
+                steps.append((rows, roots))
+            rows, roots = map(np.concatenate, zip(*steps))
+        profile.count("generations", len(steps) - 1)
+        logging.debug(
+            "Followed main branches of %d haloes in %d steps",
+            len(ids),
+            len(steps) - 1,
+        )
+
+        numbers, column = np.unique(
+            self.core["snapshotNumber"][rows], return_inverse=True
         )
+        shape = len(ids), len(numbers)
+        nodes = np.full(shape, -1, dtype=self.core["nodeIndex"].dtype)
+        nodes[roots, column] = self.core["nodeIndex"][rows]
+        masses = np.zeros(shape, dtype=self.core["particleNumber"].dtype)
+        masses[roots, column] = self.core["particleNumber"][rows]
 
-        return cmh
+        index = pd.Index(ids, name="nodeIndex")
+        columns = pd.Index(numbers, name="snapshotNumber")
+        return (
+            pd.DataFrame(nodes, index=index, columns=columns),
+            pd.DataFrame(masses, index=index, columns=columns),
+        )
+
+    def _descendant_rows(self):
+        """Returns the descendant of every halo, building it on first use.
+
+        :return numpy.ndarray: row of the ``descendantIndex`` of every row,
+            ``-1`` for none, or for a descendant outside the catalogue
+        """
+        if self._descendants is None:
+            with profile.timer("descendant_index"):
+                rows, found = self._find(self.core["descendantIndex"])
+                self._descendants = np.where(found, rows, -1)
+        return self._descendants
+
+    def descendants_until(self, ids, snapshot):
+        """Follows descendants of many haloes at once, up to a snapshot.
+
+        Every track steps from its current halo to its descendant, all
+        tracks together in one vectorised gather, and ends where there is
+        no descendant (``descendantIndex`` is ``-1``, or not read) or the
+        next one lies past ``snapshot``.
+
+        :param List[int] ids: nodeIndex values of the haloes followed
+        :param int snapshot: last snapshot followed to
+        :return pandas.DataFrame: ``nodeIndex`` of the halo, and then of its
+            descendants (rows, indexed by ``nodeIndex``) at every snapshot
+            reached up to ``snapshot`` (columns), ``-1`` where a track has
+            no halo
+        """
+        ids = np.asarray(ids)
+        descendants = self._descendant_rows()
+        number = self.core["snapshotNumber"]
+        rows, tracks = self._rows(ids), np.arange(len(ids))
+        steps = []
+        with profile.timer("descendant_search"):
+            while True:
+                found = number[rows] <= snapshot
+                rows, tracks = rows[found], tracks[found]
+                steps.append((rows, tracks))
+                rows = descendants[rows]
+                found = rows != -1
+                rows, tracks = rows[found], tracks[found]
+                if len(rows) == 0:
+                    break
+            rows, tracks = map(np.concatenate, zip(*steps))
+        logging.debug(
+            "Followed descendants of %d haloes in %d steps",
+            len(ids),
+            len(steps) - 1,
+        )
+
+        numbers, column = np.unique(number[rows], return_inverse=True)
+        table = np.full(
+            (len(ids), len(numbers)), -1, dtype=self.core["nodeIndex"].dtype
+        )
+        table[tracks, column] = self.core["nodeIndex"][rows]
+        return pd.DataFrame(
+            table,
+            index=pd.Index(ids, name="nodeIndex"),
+            columns=pd.Index(numbers, name="snapshotNumber"),
+        )
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+import json
+import logging
+import sys
+import time
+import tracemalloc
+
+import defopt
+import numpy as np
+
+from dhalo import DHaloReader
+
+
+def measure(function, repeat=1):
+    """Times a function, and tracks its peak memory use.
+
+    Memory is traced with :mod:`tracemalloc`, which NumPy reports its array
+    allocations to;  the peak is taken over the run, relative to memory
+    allocated at its start.  Log messages below ``WARNING`` are disabled
+    while the function runs.
+
+    :param Callable function: function of no arguments
+    :param int repeat: number of runs
+    :return Tuple[object, dict]: result of the last run, and the best
+        ``seconds`` and largest ``peak_bytes`` over all runs
+    """
+    best, peak = float("inf"), 0
+    # keep per-halo messages out of the timed region
+    logging.disable(logging.INFO)
+    try:
+        for _ in range(repeat):
+            tracemalloc.start()
+            start = time.perf_counter()
+            result = function()
+            best = min(best, time.perf_counter() - start)
+            current, top = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            peak = max(peak, top)
+    finally:
+        logging.disable(logging.NOTSET)
+    return result, {"seconds": best, "peak_bytes": peak}
+
+
+def main(data_file, *, haloes=1000, nfw_f=0.02, repeat=3, seed=0):
+    """Benchmark stages of the CMH pipeline.
+
+    Every stage is run ``repeat`` times on a reader cleared by
+    :meth:`dhalo.DHaloReader.reset`, so that results cached by a run (host
+    and mass columns, id, progenitor and descendant indices) are not reused
+    by the next one, or by a later stage.  A JSON list of stages, with
+    their best time and peak memory, is written to standard output.
+
+    A catalogue of any size can be generated with :mod:`src.synth`.
+
+    :param str data_file: HDF5 or cache file name.
+    :param int haloes: number of random host haloes of the last snapshot
+        whose progenitors and CMHs are computed
+    :param float nfw_f: NFW f parameter
+    :param int repeat: number of runs of every stage
+    :param int seed: random seed of the choice of haloes
+    """
+
+    results = []
+
+    def stage(name, function, n=None):
+        result, record = measure(function, repeat)
+        record = dict(stage=name, **record)
+        if n is not None:
+            record["haloes"] = n
+        results.append(record)
+        logging.info(
+            "%s: %.3fs, %.1f MiB",
+            name,
+            record["seconds"],
+            record["peak_bytes"] / 2 ** 20,
+        )
+        return result
+
+    reader = stage("load", lambda: DHaloReader(data_file))
+
+    def fresh():
+        reader.reset()
+        return reader
+
+    hosts = stage("resolve_hosts", lambda: fresh().resolve_hosts())
+    stage("host_masses", lambda: fresh().host_masses())
+    stage("progenitor_index", lambda: fresh().progenitor_index())
+
+    core = reader.core
+    last = core["snapshotNumber"] == core["snapshotNumber"].max()
+    roots = core["nodeIndex"][last & (core["nodeIndex"] == hosts)]
+    roots = np.random.default_rng(seed).choice(
+        roots, min(haloes, len(roots)), replace=False
+    )
+    reader.resolve_hosts()
+    reader.host_masses()
+    reader.progenitor_index()
+
+    stage(
+        "progenitor_search",
+        lambda: [reader.halo_progenitor_ids(i) for i in roots],
+        len(roots),
+    )
+    stage(
+        "single_cmh",
+        lambda: [reader.collapsed_mass_history(i, nfw_f) for i in roots],
+        len(roots),
+    )
+    stage(
+        "batch_cmh",
+        lambda: reader.collapsed_mass_histories(roots, nfw_f),
+        len(roots),
+    )
+    stage(
+        "main_branches",
+        lambda: fresh().main_branches(roots),
+        len(roots),
+    )
+
+    json.dump(results, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    defopt.run(main)
@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+import logging
+
+import defopt
+
+from dhalo import DHaloReader
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+def main(data_file, cache_dir, *, derived=False):
+    """Write a memory-mapped column cache of a catalogue.
+
+    :param str data_file: HDF5 file name, glob pattern or directory.
+    :param str cache_dir: cache directory name.
+    :param bool derived: also cache ``mainHostIndex`` and ``hostMass``.
+    """
+
+    reader = DHaloReader(data_file)
+    logging.debug("Initialised reader for %s file", data_file)
+
+    if derived:
+        reader.resolve_hosts()
+        reader.host_masses()
+
+    reader.write_cache(cache_dir)
+
+
+if __name__ == "__main__":
+    defopt.run(main)
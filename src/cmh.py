@@ -1,42 +1,229 @@
 #!/usr/bin/env python3
 import logging
-import sys
+import os
+from functools import partial
 
 import defopt
+import numpy as np
 import pandas as pd
 
-from dhalo import DHaloReader
+import dhalo
+from dhalo import DHaloReader, ProgenitorCache
+from forge import Checkpoint, writer
 from util import pmap
 
 logging.basicConfig(level=logging.DEBUG)
 
+reader = None
 
-def main(data_file, ids_file, nfw_f=0.02):
+
+def attach(
+    data_file, profile=False, snapshots=None, compact=False, cache=None
+):
+    """Opens the catalogue once per worker process.
+
+    :param str data_file: HDF5 or cache file name.
+    :param bool profile: whether to profile the worker, see
+        :class:`dhalo.Profile`
+    :param Tuple[int, int] snapshots: inclusive range of snapshots read
+        (default: all)
+    :param bool compact: whether to remap ids to dense row positions, see
+        :func:`dhalo.compact_catalogue`
+    :param str cache: directory of progenitor sets, see
+        :class:`dhalo.ProgenitorCache`
+    """
+    global reader
+    if profile:
+        dhalo.profile.enable()
+    reader = DHaloReader(
+        data_file,
+        snapshots=snapshots,
+        compact=compact,
+        progenitor_cache=None if cache is None else ProgenitorCache(cache),
+    )
+    logging.info("Initialised reader for %s file", data_file)
+
+
+def cmh(ids, nfw_f):
+    """Compute CMHs of a chunk of haloes, see :func:`attach`.
+
+    :param numpy.ndarray ids: nodeIndex values
+    :param list[float] nfw_f: NFW f parameters
+    :return Tuple[numpy.ndarray, Dict[float, pandas.DataFrame], dict]:
+        ``ids``, their CMHs in a wide format for every f, and the profile of
+        the chunk
+    """
+    if reader.ids is None:
+        cmhs = reader.collapsed_mass_histories(ids, nfw_f)
+    else:
+        cmhs = reader.collapsed_mass_histories(reader.compact_ids(ids), nfw_f)
+        for f, table in cmhs.items():
+            table.index = pd.Index(
+                reader.original_ids(table.index.values), name="nodeIndex"
+            )
+            cmhs[f] = table.sort_index()
+    return ids, cmhs, dhalo.profile.pop()
+
+
+def main(
+    data_file,
+    ids_file,
+    *nfw_f,
+    snapshots=None,
+    output="-",
+    processes=None,
+    chunk_size=None,
+    profile=None,
+    compact=False,
+    cache=None
+):
     """Compute CMH of a halo.
 
+    CMHs are written chunk by chunk, as soon as they are computed, with one
+    column per snapshot of the catalogue.  Chunks written to an output file
+    are recorded in a ``<output>.done`` checkpoint, see
+    :class:`forge.Checkpoint`: a run restarted with the same output skips
+    haloes already done and appends only new results.
+
+    CMHs for all values of f, and haloes of all snapshots, come from a
+    single catalogue load and progenitor search, and are written to one
+    output per snapshot and f.  Workers only load snapshots up to the last
+    one given, which skips most of a cache partitioned by snapshot.
+
     :param str data_file: HDF5 or cache file name.
-    :param str ids_file: text file with nodeIndex values
-    :param float nfw_f: NFW f parameter
+    :param str ids_file: text file with nodeIndex values; with snapshots,
+        ``{snapshot}`` in the file name is replaced with every snapshot
+        number, as three digits
+    :param float nfw_f: NFW f parameter(s) (default: 0.02)
+    :param list[int] snapshots: snapshot numbers of haloes in ``ids_file``
+    :param str output: CSV (default: standard output) or HDF5 output file;
+        ``{f}`` in the file name is replaced with f in per cent, as three
+        digits (e.g. ``002`` for 0.02), and ``{snapshot}`` as in
+        ``ids_file``;  other braces are kept as they are
+    :param int processes: number of worker processes (default: LSF slots or
+        CPU count)
+    :param int chunk_size: number of haloes per chunk
+    :param str profile: if given, file name (``-`` for standard error) of a
+        JSON summary of time spent in every stage, summed over all workers,
+        see :class:`dhalo.Profile`
+    :param bool compact: remap ids of the catalogue to dense row positions
+        in workers, see :func:`dhalo.compact_catalogue`;  this shrinks the
+        catalogue of workers reading HDF5 files from 44 to 31 bytes per
+        halo, but every worker turns the shared memory-mapped columns of a
+        cache into private copies (and sorts its ids), so that with a cache
+        it adds memory per worker instead of saving it
+    :param str cache: directory of progenitor sets, shared by workers and
+        kept between runs, so that haloes searched by an earlier run (e.g.
+        for other values of f) are not searched again, see
+        :class:`dhalo.ProgenitorCache`
     """
 
-    ids = pd.read_table(ids_file).values[:, 0]
-    logging.info("Loaded %d ids from %s", len(ids), ids_file)
+    if profile is not None:
+        dhalo.profile.enable()
 
-    reader = DHaloReader(data_file)
-    logging.info("Initialised reader for %s file", data_file)
+    nfw_f = list(nfw_f) or [0.02]
+    last = max(snapshots) if snapshots else None
+    snapshots = ["%03d" % s for s in snapshots] if snapshots else [""]
+    outputs = {
+        (s, f): output.replace("{snapshot}", s).replace(
+            "{f}", "%03d" % round(100 * f)
+        )
+        for s in snapshots
+        for f in nfw_f
+    }
+    if len(set(outputs.values())) < len(outputs):
+        raise ValueError(
+            "Output %s does not depend on {snapshot} and {f}" % output
+        )
+
+    ids_files = {s: ids_file.replace("{snapshot}", s) for s in snapshots}
+    if len(set(ids_files.values())) < len(ids_files):
+        raise ValueError(
+            "Ids file %s does not depend on {snapshot}" % ids_file
+        )
 
-    pd.concat(
-        pmap(lambda i: reader.collapsed_mass_history(i, nfw_f), ids, 8)
-    ).pivot_table(
-        index="nodeIndex",
-        values="particleNumber",
-        columns="snapshotNumber",
-        fill_value=0,
-    ).to_csv(
-        sys.stdout, index=True, index_label="nodeIndex"
+    ids = {}
+    for s, filename in ids_files.items():
+        ids[s] = np.unique(pd.read_table(filename, header=None).values[:, 0])
+        logging.info("Loaded %d ids from %s", len(ids[s]), filename)
+    group = pd.Series(
+        np.repeat(np.arange(len(snapshots)), [len(ids[s]) for s in snapshots]),
+        index=np.concatenate([ids[s] for s in snapshots]),
     )
+    ids = np.sort(group.index.values)
+
+    catalogue = DHaloReader(data_file, columns=["snapshotNumber"])
+    columns = (
+        catalogue.partitions[0]
+        if catalogue.partitions is not None
+        else np.unique(catalogue.core["snapshotNumber"])
+    )
+    del catalogue
+
+    if not os.path.exists(os.path.join(data_file, "manifest.json")):
+        logging.warning(
+            "%s is not a column cache, every worker reads its own copy",
+            data_file,
+        )
+
+    checkpoint, positions = None, {}
+    if output != "-":
+        checkpoint = Checkpoint(output)
+        if checkpoint.done:
+            positions = checkpoint.position
+            if set(positions) != set(outputs.values()):
+                raise ValueError(
+                    "Checkpoint %s does not match outputs"
+                    % checkpoint.filename
+                )
+            ids = ids[~np.isin(ids, list(checkpoint.done))]
+            logging.info(
+                "Resuming from %s, %d ids left", checkpoint.filename, len(ids)
+            )
+
+    outs = {}
+    try:
+        for key, filename in outputs.items():
+            outs[key] = writer(filename, columns, positions.get(filename))
+        for chunk_ids, chunks, stats in pmap(
+            partial(cmh, nfw_f=nfw_f),
+            ids,
+            processes,
+            chunk_size,
+            initializer=attach,
+            initargs=(
+                data_file,
+                profile is not None,
+                None if last is None else (columns[0], last),
+                compact,
+                cache,
+            ),
+        ):
+            dhalo.profile.merge(stats)
+            with dhalo.profile.timer("output"):
+                for f, chunk in chunks.items():
+                    chunk_group = group.reindex(chunk.index).values
+                    for i, s in enumerate(snapshots):
+                        outs[s, f].write(chunk[chunk_group == i])
+            if checkpoint is not None:
+                for out in outs.values():
+                    out.sync()
+                checkpoint.record(
+                    chunk_ids,
+                    {
+                        outputs[key]: out.position()
+                        for key, out in outs.items()
+                    },
+                )
+    finally:
+        for out in outs.values():
+            out.close()
+        if checkpoint is not None:
+            checkpoint.close()
 
-    logging.info("Pivoted CMHs for %d haloes, exiting.", len(ids))
+    logging.info("Computed CMHs for %d haloes, exiting.", len(ids))
+    if profile is not None:
+        dhalo.profile.dump(profile)
 
 
 if __name__ == "__main__":
@@ -1,9 +1,18 @@
 #!/usr/bin/env python3
+import logging
+
+import numpy as np
+
 from src import halo
 
+#: Dot statement of a node, see :func:`node`
+NODE = '\t%d [label="%s (%d, %d, %d)", style=filled, fillcolor=%s];\n'
+#: Dot statement of an edge from a progenitor to its descendant
+EDGE = "\t%d -> %d;\n"
+
 
 def node(h, m, m0, nfw_f):
-    return '\t%d [label="%s (%d, %d, %d)", style=filled, fillcolor=%s];\n' % (
+    return NODE % (
         h["nodeIndex"],
         "%d" % (h["nodeIndex"])
         if h["descendantIndex"] == h["descendantHost"]
@@ -15,7 +24,38 @@ def node(h, m, m0, nfw_f):
     )
 
 
-def tree(file, t, d, m0, nfw_f):
+def levels(t):
+    """Finds levels of a merger tree
+
+    Nodes of a :class:`src.tree.MergerTree` are in a breadth-first order,
+    so that every level is a consecutive range of nodes, and parents of
+    nodes never decrease;  the end of the next level is then a binary
+    search of the end of the current one in ``parent``.
+
+    Arguments:
+        t (src.tree.MergerTree): merger tree generated by
+            :func:`src.tree.build`
+    Returns:
+        numpy.ndarray: offsets, so that nodes ``offsets[k]:offsets[k + 1]``
+            are ``k`` levels above the root
+    """
+    offsets = [0, min(len(t), 1)]
+    while offsets[-1] < len(t):
+        offsets.append(np.searchsorted(t.parent, offsets[-1]))
+    return np.array(offsets, dtype=np.int64)
+
+
+def tree(
+    file,
+    t,
+    d,
+    m0,
+    nfw_f,
+    masses=None,
+    prune=False,
+    depth=None,
+    batch_size=2 ** 16,
+):
     """Generates Dot graph from merger tree
 
     Every node is formatted as follows::
@@ -27,40 +67,100 @@ def tree(file, t, d, m0, nfw_f):
     - green: halo mass exceeds fraction :math:`f`
     - red: halo mmass too small, does not count towards the assembly history
 
+    and followed by an edge to its descendant node.  Columns of nodes are
+    gathered a batch at a time, and the statements of a batch are joined
+    into one string, written at once, so that a tree of any size costs a
+    few writes.
+
     Arguments:
         file (File): file with Dot output
-        t (list): merger tree generated by :func:`tree_from_data`
-        d (numpy.ndarray): dataset provided by :mod:`src.read` module
+        t (src.tree.MergerTree): merger tree generated by
+            :func:`src.tree.build`
+        d (numpy.ndarray / src.halo.Index): dataset provided by
+            :mod:`src.read` module;  an index is built if not given
         m0 (int): mass of the root halo
         nfw_f (float): (default=0.01) NFW :math:`f` parameter
+        masses (numpy.ndarray): mass of every row of ``d`` (default:
+            :meth:`src.halo.Index.masses`)
+        prune (bool): leave out red nodes, together with their progenitors
+        depth (int): only write nodes up to this many levels above the root
+            (default: all)
+        batch_size (int): number of nodes formatted at once
+    Returns:
+        int: number of nodes written
     """
-    file.write(node(halo.get(t[0], d), halo.mass(t[0], d), m0, nfw_f))
-    for i, _ in enumerate(t[1]):
-        file.write("\t%d -> %d;\n" % (t[1][i][0], t[0]))
-        tree(file, t[1][i], d, m0, nfw_f)
+    d = halo.index(d)
+    if masses is None:
+        masses = d.masses()
+
+    offsets = levels(t)
+    if depth is not None:
+        offsets = offsets[: depth + 2]
+    n = offsets[-1]
+    m = masses[t.rows[:n]]
+    green = m > nfw_f * m0
+    if prune:
+        keep = green.copy()
+        for start, stop in zip(offsets[1:-1], offsets[2:]):
+            keep[start:stop] &= keep[t.parent[start:stop]]
+        nodes = np.flatnonzero(keep)
+    else:
+        nodes = np.arange(n)
+
+    for start in range(0, len(nodes), batch_size):
+        batch = nodes[start : start + batch_size]
+        h = d[t.rows[batch]]
+        ids = h["nodeIndex"].tolist()
+        descendants = h["descendantIndex"].tolist()
+        merging = (h["descendantIndex"] != h["descendantHost"]).tolist()
+        parents = np.where(
+            t.parent[batch] >= 0, t.ids[np.maximum(t.parent[batch], 0)], -1
+        ).tolist()
+        lines = []
+        for i, descendant, merges, main, mass, snapshot, colour, parent in zip(
+            ids,
+            descendants,
+            merging,
+            h["isMainProgenitor"].tolist(),
+            m[batch].tolist(),
+            h["snapshotNumber"].tolist(),
+            np.where(green[batch], "green", "red").tolist(),
+            parents,
+        ):
+            label = "%d > %d" % (i, descendant) if merges else "%d" % i
+            lines.append(NODE % (i, label, main, mass, snapshot, colour))
+            if parent >= 0:
+                lines.append(EDGE % (i, parent))
+        file.write("".join(lines))
+
+    logging.debug("Wrote %d of %d node(s) to Dot graph", len(nodes), len(t))
+    return len(nodes)
 
 
 def mah(file, m, progs):
     """Generates a Dot subgraph with snaphot numbers and progenitors' masses
 
+    Progenitors are sorted by snapshot once, so that those of every
+    snapshot are a slice found by binary search.
+
     Arguments:
         file (File): file with Dot output
         m (numpy.ndarray): mass assembly history generated by
             :func:`src.tree.mah`
         progs (numpy.ndarray): slice of ``data`` containing only progenitors
     """
-    file.write("\t%s;" % (" -> ".join(["snap_%02d\n" % (s[1]) for s in m])))
+    order = np.argsort(progs["snapshotNumber"], kind="stable")
+    snapshots = progs["snapshotNumber"][order]
+    ids = progs["nodeIndex"][order]
+
+    lines = ["\t%s;" % (" -> ".join(["snap_%02d\n" % (s[1]) for s in m]))]
     for s in m:
-        file.write('\tsnap_%02d [label="(%d, %02d)"];\n' % (s[1], s[2], s[1]))
-        file.write(
+        start, stop = np.searchsorted(snapshots, [s[1], s[1] + 1])
+        lines.append(
+            '\tsnap_%02d [label="(%d, %02d)"];\n' % (s[1], s[2], s[1])
+        )
+        lines.append(
             "\t{ rank=same; snap_%02d; %s };"
-            % (
-                s[1],
-                "; \n".join(
-                    map(
-                        str,
-                        progs[progs["snapshotNumber"] == s[1]]["nodeIndex"],
-                    )
-                ),
-            )
+            % (s[1], "; \n".join(map(str, ids[start:stop])))
         )
+    file.write("".join(lines))
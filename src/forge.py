@@ -1,6 +1,10 @@
 #!/usr/bin/env python
+import json
+import os
 import sys
 
+import h5py
+import numpy as np
 import pandas as pd
 
 
@@ -56,6 +60,198 @@ def cast(data):
     )
 
 
+class CSVWriter(object):
+    """Streams wide CMH tables to a CSV file, chunk by chunk
+
+    Every chunk is reindexed to the same snapshot columns, written below the
+    previous one and flushed, so that memory stays bounded and rows written
+    before a crash are kept.
+
+    Arguments:
+        filename (str): output file name, ``-`` for standard output
+        snapshots (numpy.ndarray): ``snapshotNumber`` of every column
+        position (int): if given, an existing file is truncated to this
+            :meth:`position` and appended to, instead of overwritten
+    """
+
+    def __init__(self, filename, snapshots, position=None):
+        self.snapshots = snapshots
+        if filename == "-":
+            self.file = sys.stdout
+        elif position is not None:
+            os.truncate(filename, position)
+            self.file = open(filename, "a")
+            return
+        else:
+            self.file = open(filename, "w")
+        self.file.write(
+            ",".join(["nodeIndex"] + ["%d" % s for s in snapshots]) + "\n"
+        )
+
+    def write(self, cmh):
+        """Appends a chunk of CMHs
+
+        Arguments:
+            cmh (pandas.DataFrame): CMHs in a wide format, as given by
+                :meth:`dhalo.DHaloReader.collapsed_mass_histories`
+        """
+        cmh.reindex(columns=self.snapshots, fill_value=0).to_csv(
+            self.file, header=False
+        )
+        self.file.flush()
+
+    def sync(self):
+        """Forces the output written so far to disk, so that a
+        :class:`Checkpoint` recorded next never points past it after a crash
+        """
+        if self.file is not sys.stdout:
+            os.fsync(self.file.fileno())
+
+    def position(self):
+        """Returns size of the output written so far, in bytes
+        """
+        return self.file.tell()
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
+
+
+class HDF5Writer(object):
+    """Streams wide CMH tables to an HDF5 file, chunk by chunk
+
+    The file holds a ``snapshotNumber`` dataset, and ``nodeIndex`` and
+    ``cmh`` datasets that grow by every chunk written, so that ``cmh[i, j]``
+    is the CMH of halo ``nodeIndex[i]`` at snapshot ``snapshotNumber[j]``.
+
+    Arguments:
+        filename (str): output file name
+        snapshots (numpy.ndarray): ``snapshotNumber`` of every column
+        position (int): if given, an existing file is truncated to this
+            :meth:`position` and appended to, instead of overwritten
+    """
+
+    def __init__(self, filename, snapshots, position=None):
+        self.snapshots = snapshots
+        if position is not None:
+            self.file = h5py.File(filename, "a")
+            if not np.array_equal(self.file["snapshotNumber"], snapshots):
+                raise ValueError("Snapshots of %s do not match" % filename)
+            self.file["nodeIndex"].resize((position,))
+            self.file["cmh"].resize((position, len(snapshots)))
+            return
+        self.file = h5py.File(filename, "w")
+        self.file["snapshotNumber"] = snapshots
+        self.file.create_dataset(
+            "nodeIndex", (0,), dtype=np.int64, maxshape=(None,), chunks=True
+        )
+        self.file.create_dataset(
+            "cmh",
+            (0, len(snapshots)),
+            dtype=np.int64,
+            maxshape=(None, len(snapshots)),
+            chunks=True,
+        )
+
+    def write(self, cmh):
+        """Appends a chunk of CMHs, see :meth:`CSVWriter.write`
+        """
+        n = self.file["nodeIndex"].shape[0]
+        self.file["nodeIndex"].resize((n + len(cmh),))
+        self.file["nodeIndex"][n:] = cmh.index.values
+        self.file["cmh"].resize((n + len(cmh), len(self.snapshots)))
+        self.file["cmh"][n:] = cmh.reindex(
+            columns=self.snapshots, fill_value=0
+        ).values
+        self.file.flush()
+
+    def sync(self):
+        """Forces the output written so far to disk, see
+        :meth:`CSVWriter.sync`
+        """
+        self.file.flush()
+        os.fsync(self.file.id.get_vfd_handle())
+
+    def position(self):
+        """Returns number of rows written so far
+        """
+        return self.file["nodeIndex"].shape[0]
+
+    def close(self):
+        self.file.close()
+
+
+def writer(filename, snapshots, position=None):
+    """Opens a :class:`HDF5Writer` for ``.hdf5`` and ``.h5`` files, and a
+    :class:`CSVWriter` otherwise
+
+    Arguments:
+        filename (str): output file name, ``-`` for standard output
+        snapshots (numpy.ndarray): ``snapshotNumber`` of every column
+        position (int): position to truncate an existing file to and append
+            from, see :class:`Checkpoint`
+    """
+    if os.path.splitext(filename)[1] in [".hdf5", ".h5"]:
+        return HDF5Writer(filename, snapshots, position)
+    return CSVWriter(filename, snapshots, position)
+
+
+class Checkpoint(object):
+    """Sidecar ``<output>.done`` file recording chunks of haloes done
+
+    Every line is a JSON record of a chunk written, with its ``nodeIndex``
+    values and the :meth:`CSVWriter.position` (or
+    :meth:`HDF5Writer.position`) of every output after writing it, keyed by
+    output file name.  Outputs must be synced to disk (see
+    :meth:`CSVWriter.sync`) before their positions are recorded.  On
+    restart, outputs are truncated to their last recorded positions, which
+    drops rows of a chunk cut short, and haloes already done are skipped.
+
+    Arguments:
+        filename (str): output file name, or pattern of output file names
+    """
+
+    def __init__(self, filename):
+        self.filename = "%s.done" % filename
+        self.done = set()
+        self.position = None
+        if os.path.exists(self.filename):
+            size = 0
+            with open(self.filename, "rb") as f:
+                for line in f:
+                    # a record is complete only with its newline
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        record = json.loads(line.decode())
+                    except ValueError:
+                        break
+                    self.done.update(record["ids"])
+                    self.position = record["position"]
+                    size += len(line)
+            # drop a record cut short
+            os.truncate(self.filename, size)
+        self.file = open(self.filename, "a")
+
+    def record(self, ids, position):
+        """Records a chunk of haloes as done, once its output is written
+
+        Arguments:
+            ids (numpy.ndarray): ``nodeIndex`` values of the chunk
+            position (dict): position of every output after the chunk
+        """
+        self.file.write(
+            json.dumps({"ids": [int(i) for i in ids], "position": position})
+            + "\n"
+        )
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.done.update(ids)
+
+    def close(self):
+        self.file.close()
+
+
 if __name__ == "__main__":
     tsv = sys.argv[1]
     long = pd.read_csv(tsv, sep="\t")
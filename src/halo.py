@@ -6,6 +6,228 @@ import numpy as np
 from src import read
 
 
+class Index(object):
+    """Sorted-key ``nodeIndex`` index of DHalo tree data
+
+    Built once over a record array, with a single ``argsort``;  a lookup is
+    then a binary search, instead of a scan of the whole catalogue.  An
+    index can be passed wherever the data array itself is expected, as
+    indexing it with a column name or a mask is delegated to the data.
+
+    Arguments:
+        d (numpy.ndarray): DHalo tree data, as provided by :mod:`src.read`
+    """
+
+    def __init__(self, d):
+        self.data = d
+        self.order = np.argsort(d["nodeIndex"], kind="stable")
+        self.keys = d["nodeIndex"][self.order]
+        self._masses = None
+        self._hosts = None
+        self._progenitors = None
+        self._members = None
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __len__(self):
+        return len(self.data)
+
+    def rows(self, ids):
+        """Finds row positions of haloes
+
+        Arguments:
+            ids (int / numpy.ndarray): ``nodeIndex`` value(s) queried
+        Return:
+            int / numpy.ndarray: row(s) of the data of the given ``nodeIndex``
+        """
+        rows, found = self.find(ids)
+        if not np.all(found):
+            raise IndexError(
+                "Halo id %d not found" % np.extract(~found, ids)[0]
+            )
+        return rows
+
+    def find(self, ids):
+        """Finds row positions of haloes, without failing on missing ones
+
+        Arguments:
+            ids (int / numpy.ndarray): ``nodeIndex`` value(s) queried
+        Return:
+            (numpy.ndarray, numpy.ndarray): row(s) of the data of the given
+                ``nodeIndex``, and whether each was found
+        """
+        ids = np.asarray(ids)
+        k = np.minimum(np.searchsorted(self.keys, ids), len(self.keys) - 1)
+        return self.order[k], self.keys[k] == ids
+
+    def get(self, h):
+        """Returns halo (row of data) given a ``nodeIndex``
+        """
+        return self.data[self.rows(h)]
+
+    def get_many(self, ids):
+        """Returns haloes (rows of data) given an array of ``nodeIndex``
+        """
+        return self.data[self.rows(ids)]
+
+    def masses(self):
+        """Finds mass of every halo and all its subhaloes at once
+
+        Computed on first use with a single ``bincount`` of
+        ``particleNumber`` over rows of ``hostIndex``.
+
+        Return:
+            numpy.ndarray: mass of every row of the data
+        """
+        if self._masses is None:
+            rows, found = self.find(self.data["hostIndex"])
+            self._masses = np.bincount(
+                rows[found],
+                weights=self.data["particleNumber"][found],
+                minlength=len(self.data),
+            ).astype(np.int64)
+        return self._masses
+
+    def hosts(self):
+        """Finds main host of every halo at once
+
+        Computed on first use by pointer jumping over rows of ``hostIndex``,
+        so that multiply embedded subhaloes are resolved in a few vectorised
+        steps instead of recursively, see :func:`host`.  Each pass doubles
+        the depth resolved, so that more than log2 of the number of haloes
+        passes can only mean a cycle.
+
+        Raises:
+            ValueError: if ``hostIndex`` is cyclic
+        Return:
+            numpy.ndarray: row of the main host of every row of the data
+        """
+        if self._hosts is None:
+            rows, found = self.find(self.data["hostIndex"])
+            hosts = np.where(found, rows, np.arange(len(self.data)))
+            for _ in range(int(np.log2(max(len(hosts), 1))) + 2):
+                jumped = hosts[hosts]
+                if np.array_equal(jumped, hosts):
+                    break
+                hosts = jumped
+            else:
+                raise ValueError("Cyclic hostIndex")
+            self._hosts = hosts
+        return self._hosts
+
+    def progenitors(self):
+        """Finds progenitors of every halo at once, see :func:`progenitors`
+
+        Computed on first use from the unique pairs of rows of
+        ``descendantHost`` and :meth:`hosts`, in a compressed sparse row
+        format.
+
+        Return:
+            (numpy.ndarray, numpy.ndarray): offsets and progenitor rows, so
+                that progenitors of row ``i`` are
+                ``rows[offsets[i]:offsets[i + 1]]``, in the order of rows
+        """
+        if self._progenitors is None:
+            n = len(self.data)
+            rows, found = self.find(self.data["descendantHost"])
+            pairs = np.unique(
+                rows[found].astype(np.int64) * n + self.hosts()[found]
+            )
+            offsets = np.zeros(n + 1, dtype=np.int64)
+            np.cumsum(np.bincount(pairs // n, minlength=n), out=offsets[1:])
+            self._progenitors = offsets, pairs % n
+        return self._progenitors
+
+    def members(self):
+        """Finds haloes hosted by every halo at once, see :func:`subhaloes`
+
+        Computed on first use with a single stable sort of rows on the row
+        of their ``hostIndex``, in a compressed sparse row format.  Every
+        host is a member of itself.
+
+        Return:
+            (numpy.ndarray, numpy.ndarray): offsets and member rows, so that
+                members of row ``i`` are ``rows[offsets[i]:offsets[i + 1]]``,
+                in the order of rows
+        """
+        if self._members is None:
+            n = len(self.data)
+            hosts, found = self.find(self.data["hostIndex"])
+            rows = np.flatnonzero(found)
+            rows = rows[np.argsort(hosts[rows], kind="stable")]
+            offsets = np.zeros(n + 1, dtype=np.int64)
+            np.cumsum(np.bincount(hosts[found], minlength=n), out=offsets[1:])
+            self._members = offsets, rows
+        return self._members
+
+    def substructure(self):
+        """Summarises members of every halo at once, see :meth:`members`
+
+        Every aggregate is a single ``reduceat`` over the member rows,
+        segment by segment, with no loop over hosts.
+
+        Return:
+            numpy.ndarray: record array with, for every row of the data, its
+                ``nodeIndex``, the number of its subhaloes
+                (``subhaloNumber``, itself excluded), their total
+                ``particleNumber`` and its own (``hostMass``, as
+                :meth:`masses`), and the ``nodeIndex`` and
+                ``particleNumber`` of the most massive subhalo
+                (``largestSubhalo`` and ``largestSubhaloMass``, ``-1`` and
+                ``0`` if none, the first one in the order of rows if tied)
+        """
+        offsets, rows = self.members()
+        n = len(self.data)
+        counts = np.diff(offsets)
+        starts = offsets[:-1][counts > 0]
+        host = np.repeat(np.arange(n), counts)
+        mass = self.data["particleNumber"][rows].astype(np.int64)
+        # hosts are members of themselves, but not their own subhaloes
+        sub = np.where(rows == host, -1, mass)
+
+        out = np.zeros(
+            n,
+            dtype=[
+                ("nodeIndex", np.int64),
+                ("subhaloNumber", np.int64),
+                ("hostMass", np.int64),
+                ("largestSubhalo", np.int64),
+                ("largestSubhaloMass", np.int64),
+            ],
+        )
+        out["nodeIndex"] = self.data["nodeIndex"]
+        out["subhaloNumber"] = counts - np.bincount(
+            host[rows == host], minlength=n
+        )
+        out["largestSubhalo"] = -1
+        if len(starts) == 0:
+            return out
+        out["hostMass"][counts > 0] = np.add.reduceat(mass, starts)
+        largest = np.maximum.reduceat(sub, starts)
+        first = np.minimum.reduceat(
+            np.where(
+                sub == np.repeat(largest, counts[counts > 0]),
+                np.arange(len(rows)),
+                len(rows),
+            ),
+            starts,
+        )
+        found = largest >= 0
+        hosts = np.flatnonzero(counts > 0)[found]
+        out["largestSubhalo"][hosts] = self.data["nodeIndex"][
+            rows[first[found]]
+        ]
+        out["largestSubhaloMass"][hosts] = largest[found]
+        return out
+
+
+def index(d):
+    """Returns an :class:`Index` of ``d``, unless ``d`` already is one
+    """
+    return d if isinstance(d, Index) else Index(d)
+
+
 def get(h, d):
     """Returns halo (row of data) given a ``nodeIndex``
 
@@ -14,7 +236,9 @@ def get(h, d):
 
     Arguments:
         h (int): ``nodeIndex`` queried
-        d (numpy.ndarray): DHalo tree data, as provided by :mod:`src.read`
+        d (numpy.ndarray / Index): DHalo tree data, as provided by
+            :mod:`src.read`;  if an :class:`Index`, lookup is a binary search
+            instead of a linear scan
     Return:
         h (numpy.ndarray): row of argument ``d`` of the given ``nodeIndex``
     """
@@ -22,9 +246,11 @@ def get(h, d):
     if type(h) == int or type(h) == np.int64:
         if h == -1:
             h = np.zeros(7, dtype="int")
+        elif isinstance(d, Index):
+            h = d.get(h)
         else:
             h = d[d["nodeIndex"] == h][0]
-    elif type(h) == np.ndarray or type(h) == np.void:
+    elif isinstance(h, (np.ndarray, np.void)):
         pass
     else:
         raise TypeError(
@@ -33,6 +259,19 @@ def get(h, d):
     return h
 
 
+def get_many(ids, d):
+    """Returns haloes (rows of data) given an array of ``nodeIndex``
+
+    Arguments:
+        ids (numpy.ndarray): ``nodeIndex`` values queried
+        d (numpy.ndarray / Index): DHalo tree data, as provided by
+            :mod:`src.read`;  an :class:`Index` is built if not given
+    Return:
+        numpy.ndarray: rows of argument ``d`` of the given ``nodeIndex``
+    """
+    return index(d).get_many(ids)
+
+
 def progenitors(h, d):
     """Finds progenitors of ``h``
 
@@ -41,8 +280,15 @@ def progenitors(h, d):
     - find all haloes of which ``h`` is a **host of a descendant**
     - find hosts of **these haloes**
     - keep unique ones
+
+    If ``d`` is an :class:`Index`, reads its precomputed
+    :meth:`Index.progenitors`.
     """
     h = get(h, d)
+    if isinstance(d, Index):
+        offsets, rows = d.progenitors()
+        i = d.rows(h["nodeIndex"])
+        return list(d[rows[offsets[i] : offsets[i + 1]]])
     ps = [
         h
         for h in set(
@@ -66,7 +312,7 @@ def host(h, d):
     if h["nodeIndex"] == h["hostIndex"]:
         return h
     else:
-        host(d[d["nodeIndex"] == h["hostIndex"]][0], d)
+        return host(get(h["hostIndex"], d), d)
 
 
 def is_host(h, d):
@@ -81,7 +327,7 @@ def descendant(h, d):
     """Finds descendant of ``h``
     """
     h = get(h, d)
-    return d[d["nodeIndex"] == h["descendantIndex"]][0]
+    return get(h["descendantIndex"], d)
 
 
 def descendant_host(h, d):
@@ -91,22 +337,32 @@ def descendant_host(h, d):
     in case of splitting, preventing "multiply-progenitored" haloes.
     """
     h = get(h, d)
-    return d[d["nodeIndex"] == h["descendantHost"]][0]
+    return get(h["descendantHost"], d)
 
 
 def subhaloes(h, d):
     """Finds halo indices for which ``h`` is a host
+
+    If ``d`` is an :class:`Index`, slices its precomputed
+    :meth:`Index.members`.
     """
     h = get(h, d)
+    if isinstance(d, Index):
+        offsets, rows = d.members()
+        i = d.rows(h["nodeIndex"])
+        return d["nodeIndex"][rows[offsets[i] : offsets[i + 1]]]
     return d[d["hostIndex"] == h["nodeIndex"]]["nodeIndex"]
 
 
 def mass(h, d):
     """Finds mass of central halo and all subhaloes
+
+    If ``d`` is an :class:`Index`, reads its precomputed
+    :meth:`Index.masses`.
     """
-    return np.sum(
-        np.array(map(lambda ih: get(ih, d), subhaloes(h, d)))["particleNumber"]
-    )
+    if isinstance(d, Index):
+        return d.masses()[d.rows(get(h, d)["nodeIndex"])]
+    return np.sum(get_many(subhaloes(h, d), d)["particleNumber"])
 
 
 def display(h, d, level=1, recursive=False):
@@ -166,6 +422,6 @@ def display(h, d, level=1, recursive=False):
 
 
 if __name__ == "__main__":
-    d = read.retrieve()
+    d = Index(read.retrieve(sys.argv[2]))
     for id in map(int, sys.argv[1].split(",")):
         display(id, d, recursive=False)
@@ -3,30 +3,65 @@ import logging
 import sys
 
 import defopt
+import pandas as pd
 
+import dhalo
 from dhalo import DHaloReader
 
 logging.basicConfig(level=logging.DEBUG)
 
 
-def main(filename, snapshot):
+def main(filename, *snapshots, output="-", profile=None, compact=False):
     """Query IDs of haloes.
 
+    Hosts of haloes of all snapshots are resolved at once, from a single
+    catalogue load.
+
     :param str filename: HDF5 or cache file name.
-    :param int snapshot: Snapshot number
+    :param int snapshots: Snapshot number(s), at least one
+    :param str output: output file name (default: standard output);
+        ``{snapshot}`` in it is replaced with every snapshot number, as three
+        digits;  other braces are kept as they are
+    :param str profile: if given, file name (``-`` for standard error) of a
+        JSON summary of time spent in every stage, see
+        :class:`dhalo.Profile`
+    :param bool compact: remap ids of the catalogue to dense row positions,
+        see :func:`dhalo.compact_catalogue`
     """
 
-    reader = DHaloReader(filename)
-    logging.debug("Initialised reader for %s file", filename)
+    if profile is not None:
+        dhalo.profile.enable()
+
+    if not snapshots:
+        raise ValueError("At least one snapshot number is required")
 
-    data = reader.data[reader.data["snapshotNumber"] == snapshot]
+    outputs = {s: output.replace("{snapshot}", "%03d" % s) for s in snapshots}
+    if len(set(outputs.values())) < len(outputs):
+        raise ValueError("Output %s does not depend on {snapshot}" % output)
+
+    reader = DHaloReader(
+        filename,
+        columns=["hostIndex", "snapshotNumber"],
+        snapshots=(min(snapshots), max(snapshots)),
+        compact=compact,
+    )
+    logging.debug("Initialised reader for %s file", filename)
 
-    ids = data.loc[
-        [reader.halo_host(i).name for i in data.index]
-    ].index.unique()
+    hosts = reader.resolve_hosts()
+    for snapshot, name in outputs.items():
+        ids = pd.unique(hosts[reader.snapshot_rows(snapshot)])
+        if compact:
+            ids = reader.original_ids(ids)
+        with dhalo.profile.timer("output"):
+            f = sys.stdout if name == "-" else open(name, "w")
+            for i in ids:
+                f.write("%d\n" % i)
+            if f is not sys.stdout:
+                f.close()
+        logging.info("Wrote %d ids of snapshot %d", len(ids), snapshot)
 
-    for i in ids:
-        sys.stdout.write("%d\n" % i)
+    if profile is not None:
+        dhalo.profile.dump(profile)
 
 
 if __name__ == "__main__":
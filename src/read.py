@@ -2,10 +2,11 @@
 import logging
 import sys
 
-import h5py
 import numpy as np
 import pandas as pd
 
+import dhalo
+
 columns = [
     [
         "nodeIndex",
@@ -43,7 +44,13 @@ def mock(data_frame=False):
     return d
 
 
-def data(file_hdf5, file_numpy=None, data_frame=False):
+def data(
+    file_hdf5,
+    file_numpy=None,
+    data_frame=False,
+    snapshots=None,
+    chunk_size=2 ** 22,
+):
     """Reads DHalo data into memory
 
     **Output data format:**
@@ -81,13 +88,18 @@ def data(file_hdf5, file_numpy=None, data_frame=False):
         1 if it is
 
     Arguments:
-        file_hdf5 (str): filename of an HDF5 data store
+        file_hdf5 (str): filename of an HDF5 data store, or a glob pattern or
+            directory of a catalogue split into several files
         file_numpy (str): filename to which NumPy array object can be saved
             (for faster re-reads);  this is later used for faster data
             retrieval in :func:`src.read.retrieve`;  if ``None``, no data is
             cached
         data_frame (bool): whether to return a DataFrame or not (default not,
             returns NumPy array)
+        snapshots (tuple): inclusive range of ``snapshotNumber`` of rows read
+            (default: all rows)
+        chunk_size (int): number of rows read at once, see
+            :func:`dhalo.read_hdf5`
 
     Returns:
         numpy.ndarray / pandas.DataFrame:  DHalo catalogue
@@ -101,25 +113,30 @@ def data(file_hdf5, file_numpy=None, data_frame=False):
             h = d[np.where(d[:,ID] == 123)][0]
     """
 
-    f = h5py.File(file_hdf5, "r")
-
-    d = np.core.records.fromarrays(
-        [np.array(f["/haloTrees/%s" % column].value) for column in columns[0]],
-        names=columns[0],
-        formats=columns[1],
-    )
+    # files are read one at a time straight into their rows of the record
+    # array, so that peak memory is the record array and the columns of one
+    # file, rather than the record array and all columns
+    files = dhalo.hdf5_files(file_hdf5)
+    counts = [dhalo.count_rows(f, snapshots, chunk_size) for f in files]
+    d = np.recarray(sum(counts), dtype=list(zip(columns[0], columns[1])))
+    start = 0
+    for filename, count in zip(files, counts):
+        part = dhalo.read_hdf5(
+            filename, dict(zip(columns[0], columns[1])), snapshots, chunk_size
+        )
+        for column in columns[0]:
+            d[column][start : start + count] = part.pop(column)
+        start += count
 
     # d[0] = np.array([0 for column in columns])
 
     if file_numpy is not None:
-        with open(file_numpy, "w") as file_numpy:
-            np.save(file_numpy, d)
+        np.save(file_numpy, d)
 
     if data_frame:
         d = pd.DataFrame(d, columns=columns[0])
         d.index = d.nodeIndex
 
-    f.close()
     return d
 
 
@@ -127,11 +144,14 @@ def retrieve(file_numpy):
     """Loads data saved in a NumPy binary format instead of HDF5 catalogue, as
     provided by :func:`src.read.data`
 
+    The array is memory-mapped read-only, so processes on one node share it
+    through the page cache.
+
     Arguments:
         file_numpy (str): source of NumPy binary store generated by
             :func:`src.read.data`
     """
-    return np.load(open(file_numpy, "r"))
+    return np.load(file_numpy, mmap_mode="r")
 
 
 if __name__ == "__main__":
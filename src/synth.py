@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+import logging
+import os
+
+import defopt
+import h5py
+import numpy as np
+
+from dhalo import dtypes
+
+logging.basicConfig(level=logging.DEBUG)
+
+#: ``nodeIndex`` of halo ``k`` at snapshot ``s`` is ``s * ID_STRIDE + k``
+ID_STRIDE = 10 ** 10
+
+
+def _layout(rng, haloes, subhalo_fraction, subhalo_depth):
+    """Generates hosts of haloes, shared by all snapshots.
+
+    Haloes ``0 .. (1 - subhalo_fraction) * haloes`` are hosts, the remaining
+    ones are split evenly into ``subhalo_depth`` levels, every level hosted
+    by a random halo of the level above.
+
+    :param numpy.random.Generator rng: random number generator
+    :param int haloes: number of haloes in a snapshot
+    :param float subhalo_fraction: fraction of haloes that are subhaloes
+    :param int subhalo_depth: maximum depth of embedded subhaloes
+    :return Tuple[numpy.ndarray, numpy.ndarray]: position of the host, and
+        of the main host, of every halo in its snapshot
+    """
+    host = np.arange(haloes, dtype=np.int64)
+    hosts = max(1, int(round((1 - subhalo_fraction) * haloes)))
+    levels = np.linspace(hosts, haloes, subhalo_depth + 1).astype(np.int64)
+    lo, hi = 0, hosts
+    for start, stop in zip(levels[:-1], levels[1:]):
+        host[start:stop] = rng.integers(lo, hi, stop - start)
+        lo, hi = start, stop
+    main = host.copy()
+    for _ in range(subhalo_depth):
+        main = main[main]
+    return host, main
+
+
+def _snapshot(rng, snapshot, host, main):
+    """Generates haloes of a single snapshot.
+
+    :param numpy.random.Generator rng: random number generator
+    :param int snapshot: snapshot number
+    :param numpy.ndarray host: position of the host of every halo, see
+        :func:`_layout`
+    :param numpy.ndarray main: position of the main host of every halo
+    :return Dict[str, numpy.ndarray]: ``nodeIndex``, ``hostIndex``,
+        ``snapshotNumber``, ``particleNumber``, and ``mainHost`` of every
+        halo
+    """
+    haloes = len(host)
+    node = snapshot * ID_STRIDE + np.arange(haloes, dtype=np.int64)
+    mass = 20 * (rng.pareto(0.9, haloes) + 1)
+    mass[host != np.arange(haloes)] /= 4
+    return {
+        "nodeIndex": node,
+        "hostIndex": node[host],
+        "snapshotNumber": np.full(haloes, snapshot, dtype=np.int32),
+        "particleNumber": np.minimum(mass, 2 ** 31 - 1).astype(np.int32),
+        "mainHost": main,
+    }
+
+
+def _link(rng, haloes, descendants, merger_rate):
+    """Links haloes of one snapshot to their descendants in the next.
+
+    Halo ``k`` descends into halo ``k`` of the next snapshot, unless it
+    merges, with probability ``merger_rate``, into a random one instead.
+
+    :param numpy.random.Generator rng: random number generator
+    :param dict haloes: haloes, as generated by :func:`_snapshot`
+    :param dict descendants: haloes of the next snapshot, or ``None``
+    :param float merger_rate: probability of merging into a random halo
+    """
+    n = len(haloes["nodeIndex"])
+    if descendants is None:
+        haloes["descendantIndex"] = np.full(n, -1, dtype=np.int64)
+        haloes["descendantHost"] = np.full(n, -1, dtype=np.int64)
+        haloes["isMainProgenitor"] = np.zeros(n, dtype=np.int32)
+        return
+
+    m = len(descendants["nodeIndex"])
+    desc = np.arange(n, dtype=np.int64) % m
+    merging = rng.random(n) < merger_rate
+    desc[merging] = rng.integers(0, m, np.count_nonzero(merging))
+    haloes["descendantIndex"] = descendants["nodeIndex"][desc]
+    haloes["descendantHost"] = descendants["nodeIndex"][
+        descendants["mainHost"][desc]
+    ]
+
+    order = np.lexsort((-haloes["particleNumber"], desc))
+    first = np.ones(n, dtype=bool)
+    first[1:] = desc[order][1:] != desc[order][:-1]
+    haloes["isMainProgenitor"] = np.zeros(n, dtype=np.int32)
+    haloes["isMainProgenitor"][order[first]] = 1
+
+
+def main(
+    output,
+    *,
+    rows=10 ** 6,
+    snapshots=64,
+    merger_rate=0.1,
+    subhalo_fraction=0.3,
+    subhalo_depth=2,
+    files=1,
+    seed=0
+):
+    """Write a synthetic DHalo catalogue.
+
+    Haloes are generated a snapshot at a time, so memory stays bounded by
+    two snapshots at any scale.  Every snapshot has the same number of
+    haloes, and the same hosts of (multiply embedded) subhaloes; every halo
+    but these of the last snapshot has a descendant.
+
+    :param str output: HDF5 file name; with several files, ``{file}`` in it
+        is replaced with the file number (e.g. ``tree_075.{file}.hdf5``)
+    :param int rows: total number of haloes
+    :param int snapshots: number of snapshots
+    :param float merger_rate: probability of a halo merging into a random
+        halo, instead of its own continuation, at the next snapshot
+    :param float subhalo_fraction: fraction of haloes that are subhaloes
+    :param int subhalo_depth: maximum depth of embedded subhaloes
+    :param int files: number of files the catalogue is split into, every
+        one holding a contiguous range of haloes of every snapshot
+    :param int seed: random seed
+    """
+
+    filenames = [output.format(file=i) for i in range(files)]
+    if len(set(filenames)) < files:
+        raise ValueError("Output %s does not depend on {file}" % output)
+    for filename in filenames:
+        if os.path.dirname(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+    rng = np.random.default_rng(seed)
+    haloes = rows // snapshots
+    bounds = np.linspace(0, haloes, files + 1).astype(np.int64)
+    handles = [h5py.File(filename, "w") for filename in filenames]
+    try:
+        for f in handles:
+            for column, dtype in dtypes.items():
+                f.create_dataset(
+                    "/haloTrees/%s" % column,
+                    (0,),
+                    dtype=dtype,
+                    maxshape=(None,),
+                    chunks=True,
+                )
+
+        host, main = _layout(rng, haloes, subhalo_fraction, subhalo_depth)
+        current = _snapshot(rng, 0, host, main)
+        for snapshot in range(snapshots):
+            following = (
+                _snapshot(rng, snapshot + 1, host, main)
+                if snapshot + 1 < snapshots
+                else None
+            )
+            _link(rng, current, following, merger_rate)
+            for f, start, stop in zip(handles, bounds[:-1], bounds[1:]):
+                for column in dtypes:
+                    dataset = f["/haloTrees/%s" % column]
+                    n = len(dataset)
+                    dataset.resize((n + stop - start,))
+                    dataset[n:] = current[column][start:stop]
+            logging.debug("Wrote %d haloes of snapshot %d", haloes, snapshot)
+            current = following
+    finally:
+        for f in handles:
+            f.close()
+
+    logging.info(
+        "Wrote %d haloes to %s", haloes * snapshots, ", ".join(filenames)
+    )
+
+
+if __name__ == "__main__":
+    defopt.run(main)
@@ -8,14 +8,59 @@ import numpy as np
 from src import halo, read
 
 
-def build(id, data):
-    """Generates merger tree from data
+class MergerTree(object):
+    """Merger tree of a halo, as flat arrays
+
+    Nodes are numbered in a breadth-first order, starting with the root halo
+    at ``0``, so that progenitors of every node are consecutive.  The tree
+    is then stored as the parent, first child and next sibling of every
+    node, ``-1`` where there is none, instead of embedded lists.  A halo
+    that is a progenitor of several nodes appears once under each of them.
 
-    Recursively generates a merger tree of the format::
+    Arguments:
+        rows (numpy.ndarray): row of the data of every node
+        parent (numpy.ndarray): parent (descendant) node of every node
+        ids (numpy.ndarray): ``nodeIndex`` of every node
+    """
 
-        [1, [[2, []], [3, [[4, []], [5, []]]], [6, []]]]
+    def __init__(self, rows, parent, ids):
+        self.rows = rows
+        self.parent = parent
+        self.ids = ids
+        self.first_child = np.full(len(rows), -1, dtype=np.int64)
+        self.next_sibling = np.full(len(rows), -1, dtype=np.int64)
+
+        nodes = np.flatnonzero(parent >= 0)
+        first = np.ones(len(nodes), dtype=bool)
+        first[1:] = parent[nodes[1:]] != parent[nodes[:-1]]
+        self.first_child[parent[nodes[first]]] = nodes[first]
+        self.next_sibling[nodes[:-1][~first[1:]]] = nodes[1:][~first[1:]]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def children(self, node):
+        """Finds progenitor nodes of ``node``
+
+        Arguments:
+            node (int): position of the node in the tree
+        Returns:
+            list: positions of progenitor nodes
+        """
+        children = []
+        child = self.first_child[node]
+        while child >= 0:
+            children.append(child)
+            child = self.next_sibling[child]
+        return children
+
+
+def build(id, data):
+    """Generates merger tree from data
 
-    equivalent to::
+    Iteratively generates a merger tree, one level of progenitors at a time,
+    with a breadth-first search over :meth:`src.halo.Index.progenitors`.  A
+    tree of the form::
 
         1
             2
@@ -24,74 +69,89 @@ def build(id, data):
                 5
             6
 
+    is stored as a :class:`MergerTree` of nodes ``[1, 2, 3, 6, 4, 5]``.
+
     Arguments:
         id (int): ``nodeIndex`` of the starting halo
-        data (numpy.ndarray): dataset provided by :mod:`src.read` module
+        data (numpy.ndarray / src.halo.Index): dataset provided by
+            :mod:`src.read` module;  an index is built if not given
     Returns:
-        list: merger tree in a deeply mebedded format, rooted at the starting
-            halo
+        MergerTree: merger tree rooted at the starting halo
     """
-    if not halo.is_host(id, d):
+    data = halo.index(data)
+    h = halo.get(id, data)
+    if not halo.is_host(h, data):
         raise ValueError("Not a host halo!")
 
-    h = halo.get(id, data)
-    progenitors = halo.progenitors(h, data)
-    logging.debug(
-        "Reached halo %d with %d progenitor(s)"
-        % (h["nodeIndex"], len(progenitors))
-    )
-    return [
-        h["nodeIndex"],
-        []
-        if len(progenitors) == 0
-        else [build(progenitor, data) for progenitor in progenitors],
-    ]
+    offsets, progenitors = data.progenitors()
+    level = np.atleast_1d(data.rows(h["nodeIndex"]))
+    rows, parent = [level], [np.array([-1])]
+    start = 0
+    while len(level) > 0:
+        counts = offsets[level + 1] - offsets[level]
+        ends = np.cumsum(counts)
+        level = progenitors[
+            np.arange(ends[-1])
+            + np.repeat(offsets[level] + counts - ends, counts)
+        ]
+        rows.append(level)
+        parent.append(np.repeat(np.arange(start, start + len(counts)), counts))
+        start += len(counts)
+        logging.debug(
+            "Reached %d progenitor(s) of halo %d", len(level), h["nodeIndex"]
+        )
+
+    rows = np.concatenate(rows)
+    return MergerTree(rows, np.concatenate(parent), data["nodeIndex"][rows])
 
 
 def flatten(tree):
     """Finds all ``nodeIndex`` values belonging to a given merger tree
 
     Arguments:
-        tree (list): merger tree generated by :func:`build`
+        tree (MergerTree): merger tree generated by :func:`build`
     Returns:
-        generator: to be fed as an argument to the ``list()`` function
-    **References:**
-        https://stackoverflow.com/a/2158532
+        numpy.ndarray: ``nodeIndex`` of every node, root first
     """
-    for node in tree:
-        try:
-            for subnode in flatten(node):
-                yield subnode
-        except:
-            yield node
+    return tree.ids
 
 
-def mah(tree, progs, data, m0, nfw_f):
+def mah(tree, data, m0, nfw_f):
     """Calculates mass assembly history from a given merger tree
 
+    Masses of all progenitors are read at once from
+    :meth:`src.halo.Index.masses`, the :math:`f` cut is applied as a mask,
+    and sums over every snapshot of every tree come from a single
+    ``bincount`` of a combined (tree, snapshot) key.
+
     Arguments:
-        tree (list): merger tree, generated by :func:`tree`
-        progs (numpy.ndarray): all prigenitors of the root halo in a merger
-            tree (effectively a flattened tree), calculated by :func:`flatten`,
-            a subset of ``data``
-        data (numpy.ndarray): dataset provided by :mod:`src.read` module
-        m0 (int): mass of the root halo
+        tree (MergerTree / list): merger tree(s), generated by :func:`build`
+        data (numpy.ndarray / src.halo.Index): dataset provided by
+            :mod:`src.read` module;  an index is built if not given
+        m0 (int / numpy.ndarray): mass of the root halo of every tree
         nfw_f (float): NFW :math:`f` parameter
     Returns:
         numpy.ndarray: MAH with rows formatted like ``[nodeIndex,
-            snapshotNumber, sum(particleNumber)]``
+            snapshotNumber, sum(particleNumber)]``, tree by tree, for every
+            snapshot with progenitors
     """
-    mah = []
-    root = halo.get(tree[0], progs)
+    data = halo.index(data)
+    trees = [tree] if isinstance(tree, MergerTree) else list(tree)
+    rows = np.concatenate([t.rows for t in trees])
+    which = np.repeat(np.arange(len(trees)), [len(t) for t in trees])
+
+    m = data.masses()[rows]
+    m[m <= nfw_f * np.broadcast_to(m0, len(trees))[which]] = 0
+    snapshots = data["snapshotNumber"][rows].astype(np.int64)
+    first = snapshots.min()
+    width = snapshots.max() - first + 1
+    key = which * width + snapshots - first
 
-    for snap in np.unique(progs["snapshotNumber"]):
-        sum_m = 0
-        for h in progs[progs["snapshotNumber"] == snap]:
-            m = halo.mass(h, data)
-            if m > nfw_f * m0:
-                sum_m += m
-        mah.append([root["nodeIndex"], snap, sum_m])
-    return np.array(mah)
+    size = len(trees) * width
+    sums = np.bincount(key, weights=m, minlength=size).astype(np.int64)
+    k = np.flatnonzero(np.bincount(key, minlength=size))
+    roots = data["nodeIndex"][[t.rows[0] for t in trees]]
+    return np.column_stack([roots[k // width], k % width + first, sums[k]])
 
 
 if __name__ == "__main__":
@@ -105,7 +165,7 @@ if __name__ == "__main__":
     root = int(sys.argv[2])
     file_csv = sys.argv[3]
 
-    d = read.retrieve(file_numpy)
+    d = halo.Index(read.retrieve(file_numpy))
     h = halo.get(root, d)
 
     nfw_f = 0.01
@@ -116,8 +176,8 @@ if __name__ == "__main__":
     )
 
     t = build(h, d)
-    p = np.array([halo.get(id, d) for id in list(flatten(t))])
-    m = mah(t, p, d, m0, nfw_f)
+    p = d[t.rows]
+    m = mah(t, d, m0, nfw_f)
     logging.info(
         "Built a tree rooted at halo %d with %d children" % (root, p.shape[0])
     )
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+import logging
+import multiprocessing
+import os
+import time
+import traceback
+
+
+def default_processes():
+    """Default number of worker processes.
+
+    :return int: number of slots given to the job by LSF
+        (``LSB_DJOB_NUMPROC``), or the number of CPUs outside of LSF
+    """
+    return int(os.environ.get("LSB_DJOB_NUMPROC", os.cpu_count() or 1))
+
+
+def chunks(items, chunk_size):
+    """Splits items into consecutive chunks.
+
+    :param Sequence items: items to split
+    :param int chunk_size: maximum number of items in a chunk
+    :return List[Sequence]: chunks, in order
+    """
+    return [
+        items[start : start + chunk_size]
+        for start in range(0, len(items), chunk_size)
+    ]
+
+
+#: Traceback of an ``initializer`` of :func:`pmap` that failed in this worker
+_initializer_error = None
+
+
+def _initialize(initializer, *initargs):
+    """Calls ``initializer`` in a worker, keeping its error for the first
+    chunk: a pool re-spawns workers whose initializer raises, forever.
+    """
+    global _initializer_error
+    try:
+        initializer(*initargs)
+    except Exception:
+        _initializer_error = traceback.format_exc()
+
+
+def _timed(function_chunk):
+    if _initializer_error is not None:
+        raise RuntimeError(
+            "Initializer of worker %d failed:\n%s"
+            % (os.getpid(), _initializer_error)
+        )
+    function, chunk = function_chunk
+    start = time.time()
+    result = function(chunk)
+    return result, time.time() - start
+
+
+def pmap(
+    function,
+    items,
+    processes=None,
+    chunk_size=None,
+    initializer=None,
+    initargs=(),
+):
+    """Maps a function over chunks of items, in parallel.
+
+    ``function`` is called once per chunk and has to be picklable (defined
+    at module level), as has everything it is bound to.  Large state, such as
+    a :class:`dhalo.DHaloReader`, should not be: instead, ``initializer`` sets
+    it up once in every worker, e.g. by memory-mapping a column cache, which
+    workers then share through the page cache.  With a single process,
+    chunks are mapped serially, in this process, after calling
+    ``initializer`` here.
+
+    :param Callable function: function of a chunk of items
+    :param Sequence items: items to process
+    :param int processes: number of worker processes (default:
+        :func:`default_processes`)
+    :param int chunk_size: number of items per chunk (default: items split
+        evenly, four chunks per process)
+    :param Callable initializer: called with ``initargs`` in every worker
+        before any chunk is processed;  if it raises, so does the first
+        chunk, and the map fails
+    :param tuple initargs: arguments of ``initializer``
+    :return generator: results of ``function``, one per chunk, in order
+    """
+    if processes is None:
+        processes = default_processes()
+    if chunk_size is None:
+        chunk_size = max(1, -(-len(items) // (4 * processes)))
+    parts = chunks(items, chunk_size)
+    logging.info(
+        "Mapping %d items in %d chunks over %d process(es)",
+        len(items),
+        len(parts),
+        processes,
+    )
+
+    if processes > 1:
+        pool = multiprocessing.Pool(
+            processes,
+            None if initializer is None else _initialize,
+            (initializer,) + tuple(initargs),
+        )
+        results = pool.imap(_timed, [(function, part) for part in parts])
+    else:
+        pool = None
+        if initializer is not None:
+            initializer(*initargs)
+        results = map(_timed, [(function, part) for part in parts])
+
+    try:
+        for i, (result, elapsed) in enumerate(results):
+            logging.info(
+                "Chunk %d/%d (%d items) done in %.3f s",
+                i + 1,
+                len(parts),
+                len(parts[i]),
+                elapsed,
+            )
+            yield result
+    finally:
+        if pool is not None:
+            pool.terminate()
@@ -0,0 +1,81 @@
+import h5py
+import numpy as np
+import pandas as pd
+import pytest
+
+from dhalo import DHaloReader, dtypes
+from src import read, synth
+
+
+@pytest.fixture(scope="module")
+def mock(tmp_path_factory):
+    """:func:`src.read.mock` as an HDF5 catalogue, every halo a host"""
+    d = read.mock()
+    columns = dict(zip(read.columns[0], d.T))
+    columns["hostIndex"] = columns["nodeIndex"]
+    columns["descendantHost"] = columns["descendantIndex"]
+    columns["isMainProgenitor"] = np.array([0, 1, 0, 1, 0, 1, 0, 1, 1, 0])
+    filename = str(tmp_path_factory.mktemp("mock") / "tree_004.0.hdf5")
+    with h5py.File(filename, "w") as f:
+        for column, dtype in dtypes.items():
+            f["/haloTrees/%s" % column] = columns[column].astype(dtype)
+    return filename
+
+
+@pytest.fixture(scope="module")
+def synthetic(tmp_path_factory):
+    """A catalogue of :mod:`src.synth`, split into two files"""
+    directory = tmp_path_factory.mktemp("synth")
+    synth.main(
+        str(directory / "tree_019.{file}.hdf5"),
+        rows=20000,
+        snapshots=20,
+        files=2,
+        seed=1,
+    )
+    return str(directory)
+
+
+def hosts(reader):
+    """``nodeIndex`` of host haloes of the last snapshot"""
+    core = reader.core
+    last = core["snapshotNumber"] == core["snapshotNumber"].max()
+    return core["nodeIndex"][last & (core["nodeIndex"] == core["hostIndex"])]
+
+
+def check(reader, ids, nfw_f):
+    """Compares batch CMHs with CMHs of every halo on its own"""
+    batch = reader.collapsed_mass_histories(ids, nfw_f)
+    assert batch.index.tolist() == sorted(ids)
+    for i in ids:
+        single = reader.collapsed_mass_history(i, nfw_f)
+        expected = pd.Series(
+            single["particleNumber"].values,
+            index=single["snapshotNumber"].values,
+        )
+        row = batch.loc[i]
+        assert (row.reindex(expected.index).values == expected.values).all()
+        assert (row.drop(expected.index) == 0).all()
+
+
+def test_mock_cmh(mock):
+    reader = DHaloReader(mock)
+    cmh = reader.collapsed_mass_histories([0, 6], 0.02)
+    assert cmh.loc[0].to_dict() == {1: 5, 2: 10, 3: 8, 4: 10}
+    assert cmh.loc[6].to_dict() == {1: 0, 2: 4, 3: 4, 4: 4}
+
+
+@pytest.mark.parametrize("nfw_f", [0.0, 0.02, 0.3])
+def test_mock_batch_matches_single(mock, nfw_f):
+    check(DHaloReader(mock), [0, 6], nfw_f)
+
+
+@pytest.mark.parametrize("compact", [False, True])
+@pytest.mark.parametrize("nfw_f", [0.02, 0.1])
+def test_synthetic_batch_matches_single(synthetic, compact, nfw_f):
+    reader = DHaloReader(synthetic)
+    ids = np.random.default_rng(0).choice(hosts(reader), 50, replace=False)
+    if compact:
+        reader = DHaloReader(synthetic, compact=True)
+        ids = reader.compact_ids(ids)
+    check(reader, ids.tolist(), nfw_f)
@@ -0,0 +1,85 @@
+import h5py
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.forge import Checkpoint, writer
+
+SNAPSHOTS = np.arange(4)
+
+
+def chunk(ids):
+    """Wide CMHs of a chunk of haloes, as written by ``cmh.py``"""
+    return pd.DataFrame(
+        np.outer(ids, SNAPSHOTS + 1),
+        index=pd.Index(ids, name="nodeIndex"),
+        columns=SNAPSHOTS,
+    )
+
+
+CHUNKS = [np.array([10, 11]), np.array([12, 13, 14]), np.array([15])]
+
+
+def run(filename, chunks, resume=False):
+    """Writes and checkpoints chunks the way ``cmh.py`` does"""
+    checkpoint = Checkpoint(filename)
+    position = checkpoint.position[filename] if resume else None
+    out = writer(filename, SNAPSHOTS, position)
+    for ids in chunks:
+        if not set(ids) <= checkpoint.done:
+            out.write(chunk(ids))
+            out.sync()
+            checkpoint.record(ids, {filename: out.position()})
+    out.close()
+    checkpoint.close()
+    return checkpoint
+
+
+def contents(filename):
+    if filename.endswith(".hdf5"):
+        with h5py.File(filename, "r") as f:
+            return f["nodeIndex"][:].tolist(), f["cmh"][:].tolist()
+    with open(filename) as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("extension", [".csv", ".hdf5"])
+@pytest.mark.parametrize(
+    "torn",
+    [
+        # a record cut mid-line
+        '{"ids": [12, 13, 14], "posi',
+        # a complete record but for its newline
+        '{"ids": [12, 13, 14], "position": {"%s": 999}}',
+    ],
+)
+def test_resume_after_torn_record(tmp_path, extension, torn):
+    expected = str(tmp_path / ("expected" + extension))
+    run(expected, CHUNKS)
+
+    filename = str(tmp_path / ("out" + extension))
+    run(filename, CHUNKS[:1])
+    # crash while writing the second chunk, after its rows but before its
+    # record reached disk in full
+    out = writer(filename, SNAPSHOTS, Checkpoint(filename).position[filename])
+    out.write(chunk(CHUNKS[1]))
+    out.close()
+    with open(filename + ".done", "a") as f:
+        f.write(torn.replace("%s", filename))
+
+    checkpoint = Checkpoint(filename)
+    assert checkpoint.done == set(CHUNKS[0])
+    checkpoint.close()
+    with open(filename + ".done", "rb") as f:
+        assert f.read().endswith(b"}\n")
+
+    checkpoint = run(filename, CHUNKS, resume=True)
+    assert checkpoint.done == set(np.concatenate(CHUNKS))
+    assert contents(filename) == contents(expected)
+
+
+def test_resume_skips_done(tmp_path):
+    filename = str(tmp_path / "out.csv")
+    run(filename, CHUNKS[:2])
+    run(filename, CHUNKS, resume=True)
+    assert pd.read_csv(filename).nodeIndex.tolist() == list(range(10, 16))